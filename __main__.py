@@ -1,20 +1,150 @@
 # -*- coding: utf-8 -*-
 
+import re
+import sys
+import Queue
 import getpass
+import argparse
+import threading
 from line import LineClient
+from line.keystore import Keystore
+from line.health import checkTokens
 
-def GetLineAuthToken(username, password):
-    return LineClient(username, password).authToken;
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
-username = raw_input("Username: ");
-password = getpass.getpass();
+class BatchLineClient(LineClient):
+    """LineClient that shows PinCodes on stderr, tagged with the account"""
 
-print;
+    def showPinCode(self, pinCode):
+        sys.stderr.write("[%s] Enter PinCode '%s' to your mobile phone in 2 minutes\n"
+                         % (self.id, pinCode));
 
-authToken = GetLineAuthToken(username, password);
+def GetLineAuthToken(username, password, client_class=LineClient, keystore=None):
+    return client_class(username, password, lazy=True, keystore=keystore).authToken;
 
-print;
+def ReadCredentials(f):
+    """Yield (username, password) from lines of `username<TAB>password`
+    or `username password`; blank lines and # comments are skipped"""
+    for line in f:
+        line = line.rstrip("\r\n");
 
-divider = ("-" * len(authToken));
+        if not line.strip() or line.startswith("#"):
+            continue;
 
-print("authToken:\n{0}\n{1}\n{2}".format(divider, authToken, divider));
+        fields = re.split(r"[\t ]", line, 1);
+        if len(fields) != 2:
+            sys.stderr.write("skipping malformed line: %r\n" % line);
+            continue;
+
+        yield fields[0], fields[1];
+
+def GetLineAuthTokens(credentials, output, jobs=8, keystore=None):
+    """Log in to many accounts at once, at most `jobs` logins in flight,
+    and write one JSON line per account to `output` as each finishes"""
+    tasks = Queue.Queue();
+    lock  = threading.Lock();
+
+    for username, password in credentials:
+        tasks.put((username, password));
+
+    def worker():
+        while True:
+            try:
+                username, password = tasks.get_nowait();
+            except Queue.Empty:
+                return;
+
+            try:
+                result = {"username": username,
+                          "authToken": GetLineAuthToken(username, password, BatchLineClient, keystore)};
+            except Exception as e:
+                result = {"username": username, "error": str(e)};
+
+            with lock:
+                output.write(json.dumps(result) + "\n");
+                output.flush();
+
+    threads = [threading.Thread(target=worker) for i in xrange(min(jobs, tasks.qsize()))];
+
+    for thread in threads:
+        thread.daemon = True;
+        thread.start();
+
+    # join with a timeout so Ctrl-C still reaches the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1);
+
+def ReadTokens(f):
+    """Yield authTokens from plain lines or from JSON lines written by
+    batch mode"""
+    for line in f:
+        line = line.strip();
+
+        if not line or line.startswith("#"):
+            continue;
+
+        if line.startswith("{"):
+            authToken = json.loads(line).get("authToken");
+            if authToken:
+                yield authToken;
+        else:
+            yield line;
+
+def CheckLineAuthTokens(authTokens, output, jobs=32):
+    """Write one JSON line with the status of each authToken"""
+    for result in checkTokens(authTokens, jobs):
+        output.write(json.dumps(result) + "\n");
+        output.flush();
+
+def main():
+    parser = argparse.ArgumentParser(description="Get LINE API authentication tokens.");
+    parser.add_argument("--batch", metavar="FILE",
+                        help="read `username<TAB>password` lines from FILE ('-' for stdin) "
+                             "and print one JSON line per account");
+    parser.add_argument("--check-tokens", metavar="FILE",
+                        help="check the authTokens in FILE ('-' for stdin), one per line "
+                             "or as batch mode JSON lines, and print their status");
+    parser.add_argument("--jobs", type=int, default=8,
+                        help="logins or token checks in flight at once (default: 8)");
+    parser.add_argument("--keystore", metavar="FILE",
+                        help="reuse and save authTokens and certificates in FILE "
+                             "to skip PinCodes on later logins");
+    args = parser.parse_args();
+
+    keystore = Keystore(args.keystore) if args.keystore else None;
+
+    if args.check_tokens:
+        if args.check_tokens == "-":
+            CheckLineAuthTokens(ReadTokens(sys.stdin), sys.stdout, args.jobs);
+        else:
+            with open(args.check_tokens) as f:
+                CheckLineAuthTokens(ReadTokens(f), sys.stdout, args.jobs);
+        return;
+
+    if args.batch:
+        if args.batch == "-":
+            GetLineAuthTokens(ReadCredentials(sys.stdin), sys.stdout, args.jobs, keystore);
+        else:
+            with open(args.batch) as f:
+                GetLineAuthTokens(ReadCredentials(f), sys.stdout, args.jobs, keystore);
+        return;
+
+    username = raw_input("Username: ");
+    password = getpass.getpass();
+
+    print;
+
+    authToken = GetLineAuthToken(username, password, keystore=keystore);
+
+    print;
+
+    divider = ("-" * len(authToken));
+
+    print("authToken:\n{0}\n{1}\n{2}".format(divider, authToken, divider));
+
+if __name__ == "__main__":
+    main();
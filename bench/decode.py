@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+    bench.decode
+    ~~~~~~~~~~~~
+
+    Times decoding of large `getContacts` replies and `fetchOperations`
+    batches with the pure-Python compact protocol and, when thrift's C
+    extension is installed, the accelerated one.
+
+        $ python -m bench.decode --sizes 1000,10000 --output decode.json
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import line
+from line.transport import ACCELERATED, compactProtocol
+from curve import CurveThrift
+from curve.ttypes import Contact, Message, Operation, OperationType
+
+from thrift.Thrift import TMessageType
+from thrift.transport import TTransport
+
+from bench.server import PROFILE_MID, mid
+from bench.run import timed
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def reply(name, result):
+    """Serialized reply frame of `name` returning `result`"""
+    transport = TTransport.TMemoryBuffer()
+    protocol  = compactProtocol(transport)
+
+    protocol.writeMessageBegin(name, TMessageType.REPLY, 0)
+    getattr(CurveThrift, name + "_result")(success=result).write(protocol)
+    protocol.writeMessageEnd()
+
+    return transport.getvalue()
+
+def contactsReply(size):
+    return reply('getContacts', [Contact(mid=mid("u", i + 1),
+                                         displayName="contact %d" % i,
+                                         statusMessage="status %d" % i)
+                                 for i in xrange(size)])
+
+def operationsReply(size):
+    now = int(time.time() * 1000)
+
+    return reply('fetchOperations', [Operation(revision=i + 1, type=OperationType.RECEIVE_MESSAGE,
+                                               message=Message(_from=mid("u", i % 1000 + 1), to=PROFILE_MID,
+                                                               toType=0, id=str(i + 1), createdTime=now,
+                                                               text="message %d" % i,
+                                                               contentType=0, hasContent=False))
+                                     for i in xrange(size)])
+
+def benchDecode(name, frame, size, repeat, accelerated):
+    def run():
+        for i in xrange(repeat):
+            client = CurveThrift.Client(compactProtocol(TTransport.TMemoryBuffer(frame),
+                                                        accelerated))
+            getattr(client, 'recv_' + name)()
+
+    return timed(name + (' (accelerated)' if accelerated else ''), size * repeat, run,
+                 bytes=len(frame), accelerated=accelerated)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Thrift decoding of large replies.")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="contacts and operations per reply")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    if not ACCELERATED:
+        sys.stderr.write("thrift C extension not found, timing the pure-Python protocol only\n")
+
+    results = []
+
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        for name, frame in (('getContacts', contactsReply(size)),
+                            ('fetchOperations', operationsReply(size))):
+            results.append(benchDecode(name, frame, size, args.repeat, False))
+            if ACCELERATED:
+                results.append(benchDecode(name, frame, size, args.repeat, True))
+
+    report = json.dumps({
+        'version': line.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'accelerated': ACCELERATED,
+        'results': results,
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print report
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+    bench.replay
+    ~~~~~~~~~~~~
+
+    Replays a recording made with `LineClient(record=...)` and profiles
+    `longPoll` dispatch and `LineMessage` construction.
+
+        $ python -m bench.replay traffic.rec --fast --profile
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import pstats
+import cProfile
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from line import LineClient
+from line.replay import TrafficReplay
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def replay(path, speed=1.0, count=50):
+    """Build a client on the recording and drain its operations
+
+    :returns: number of messages dispatched
+    """
+    client = LineClient(authToken="replay", replay=TrafficReplay(path, speed))
+
+    received = 0
+    while True:
+        try:
+            events = list(client.longPoll(count))
+        except Exception:
+            break
+
+        for receiver, message in events:
+            message.sender
+            message.createdTime
+            received += 1
+
+    return received
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded LINE traffic.")
+    parser.add_argument("recording")
+    parser.add_argument("--fast", action="store_true",
+                        help="replay as fast as possible instead of at recorded speed")
+    parser.add_argument("--count", type=int, default=50,
+                        help="count passed to fetchOperations, as when recording")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the top functions by cumulative time")
+    args = parser.parse_args()
+
+    speed    = None if args.fast else 1.0
+    profiler = cProfile.Profile() if args.profile else None
+
+    start = time.time()
+    if profiler:
+        received = profiler.runcall(replay, args.recording, speed, args.count)
+    else:
+        received = replay(args.recording, speed, args.count)
+    seconds = time.time() - start
+
+    print json.dumps({'messages': received, 'seconds': seconds,
+                      'per_second': received / seconds if seconds else None})
+
+    if profiler:
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+
+if __name__ == "__main__":
+    main()
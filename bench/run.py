@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+    bench.run
+    ~~~~~~~~~
+
+    Benchmarks LineClient against a local `FakeLineServer` and prints
+    the results as JSON, so runs of different versions can be compared.
+
+        $ python -m bench.run --sizes 100,10000 --output before.json
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import time
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import line
+from line import LineClient
+from curve import CurveThrift
+
+from bench.server import FakeTalkService, FakeLineServer
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def clientClass(url):
+    """LineClient talking to the server at `url`"""
+    class BenchLineClient(LineClient):
+        LINE_DOMAIN            = url
+        LINE_HTTP_URL          = url + "/api/v4/TalkService.do"
+        LINE_HTTP_IN_URL       = url + "/P4"
+        LINE_CERTIFICATE_URL   = url + "/Q"
+        LINE_SESSION_LINE_URL  = url + "/authct/v1/keys/line"
+        LINE_SESSION_NAVER_URL = url + "/authct/v1/keys/naver"
+
+        def showPinCode(self, pinCode):
+            pass
+
+    return BenchLineClient
+
+def timed(name, n, func, **extra):
+    start   = time.time()
+    func()
+    seconds = time.time() - start
+
+    result = {'name': name, 'n': n, 'seconds': seconds,
+              'per_second': n / seconds if seconds else None}
+    result.update(extra)
+
+    sys.stderr.write("%-24s n=%-8d %.3fs\n" % (name, n, seconds))
+
+    return result
+
+def benchLogin(Client, n):
+    def run():
+        for i in xrange(n):
+            Client("bench@example.com", "password", lazy=True)
+
+    return timed('login', n, run)
+
+def benchRefresh(Client, service, size):
+    service.resize(size, max(1, size / 100))
+    client = Client(authToken="authToken", lazy=True)
+
+    return [timed('refreshContacts', size, client.refreshContacts),
+            timed('refreshGroups', len(service.groups), client.refreshGroups)]
+
+def benchLongPoll(Client, service, n, count=100):
+    service.resize(1000, 10)
+    service.messages = n
+
+    client = Client(authToken="authToken")
+    client.revision = 0
+
+    def run():
+        received = 0
+        while received < n:
+            for receiver, message in client.longPoll(count):
+                message.sender
+                received += 1
+
+    return timed('longPoll', n, run, count=count)
+
+def benchSend(Client, service, n, workers=8):
+    service.resize(1000, 10)
+    client = Client(authToken="authToken")
+    ids    = sorted(service.contacts)
+
+    def serial():
+        for i in xrange(n):
+            client._sendMessage(CurveThrift.Message(to=ids[i % len(ids)], text="bench"))
+
+    def fanout():
+        client.broadcast([ids[i % len(ids)] for i in xrange(n)], "bench", workers)
+
+    return [timed('sendMessage', n, serial),
+            timed('broadcast', n, fanout, workers=workers)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LineClient against a local server.")
+    parser.add_argument("--sizes", default="100,10000,100000",
+                        help="contact counts for the refresh benchmarks")
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--sends", type=int, default=2000)
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    service = FakeTalkService()
+    server  = FakeLineServer(service).start()
+    Client  = clientClass(server.url)
+
+    results = [benchLogin(Client, args.logins)]
+
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        results.extend(benchRefresh(Client, service, size))
+
+    results.append(benchLongPoll(Client, service, args.messages))
+    results.extend(benchSend(Client, service, args.sends))
+
+    report = json.dumps({
+        'version': line.__version__,
+        'python': platform.python_version(),
+        'time': int(time.time()),
+        'results': results,
+    }, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print report
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
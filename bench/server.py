@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    bench.server
+    ~~~~~~~~~~~~
+
+    Local stand-in for the LINE servers, speaking `TCompactProtocol` over
+    HTTP on the same paths as the real ones.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import rsa
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+
+from curve import CurveThrift
+from curve.ttypes import Contact, Group, Profile, Message, Operation, \
+                         OperationType, LoginResult
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+PROFILE_MID = "u" + "0" * 32
+
+def mid(prefix, i):
+    return "%s%032x" % (prefix, i)
+
+class FakeTalkService(object):
+    """Answers the TalkService calls LineClient makes, from generated
+    data of configurable size
+
+    :param contacts: number of contacts
+    :param groups: number of groups
+    :param members: members per group
+    :param messages: RECEIVE_MESSAGE operations served by fetchOperations
+    """
+    def __init__(self, contacts=100, groups=10, members=20, messages=0):
+        self.resize(contacts, groups, members)
+        self.messages = messages
+
+        self.keys = rsa.newkeys(512)
+        self.sent = 0
+
+    def resize(self, contacts, groups, members=20):
+        self.contacts = dict((mid("u", i + 1), Contact(
+                                mid=mid("u", i + 1),
+                                displayName="contact %d" % i,
+                                statusMessage="status %d" % i))
+                             for i in xrange(contacts))
+
+        ids = sorted(self.contacts)
+        self.groups = dict((mid("c", i + 1), Group(
+                              id=mid("c", i + 1),
+                              name="group %d" % i,
+                              creator=self.contacts[ids[0]] if ids else None,
+                              members=[self.contacts[ids[(i + j) % len(ids)]]
+                                       for j in xrange(min(members, len(ids)))],
+                              invitee=[]))
+                           for i in xrange(groups))
+
+    # login
+
+    def loginWithIdentityCredentialForCertificate(self, *args):
+        return LoginResult(verifier="verifier", pinCode="0000", type=3)
+
+    def loginWithVerifierForCertificate(self, verifier):
+        return LoginResult(authToken="authToken", certificate="certificate", type=1)
+
+    # state
+
+    def getProfile(self):
+        return Profile(mid=PROFILE_MID, displayName="bench", statusMessage="")
+
+    def getLastOpRevision(self):
+        return 0
+
+    def getAllContactIds(self):
+        return sorted(self.contacts)
+
+    def getContacts(self, ids):
+        return [self.contacts[id] for id in ids if id in self.contacts]
+
+    def getGroupIdsJoined(self):
+        return sorted(self.groups)
+
+    def getGroups(self, ids):
+        return [self.groups[id] for id in ids if id in self.groups]
+
+    # messages
+
+    def fetchOperations(self, localRev, count):
+        ids = sorted(self.contacts) or [PROFILE_MID]
+        now = int(time.time() * 1000)
+
+        return [Operation(revision=revision, type=OperationType.RECEIVE_MESSAGE,
+                          message=Message(_from=ids[revision % len(ids)], to=PROFILE_MID,
+                                          toType=0, id=str(revision), createdTime=now,
+                                          text="message %d" % revision,
+                                          contentType=0, hasContent=False))
+                for revision in xrange(localRev + 1, min(localRev + count, self.messages) + 1)]
+
+    def sendMessage(self, seq, message):
+        self.sent += 1
+        message.id = str(self.sent)
+
+        return message
+
+    def getRecentMessages(self, messageBoxId, count):
+        return []
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # buffer the response, so the status line, headers and body go out in
+    # one write instead of stalling on delayed ACKs between them
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+
+        itrans = TTransport.TMemoryBuffer(body)
+        otrans = TTransport.TMemoryBuffer()
+
+        self.server.processor.process(TCompactProtocol.TCompactProtocol(itrans),
+                                      TCompactProtocol.TCompactProtocol(otrans))
+
+        self._reply('application/x-thrift', otrans.getvalue())
+
+    def do_GET(self):
+        if self.path.startswith("/authct/v1/keys/"):
+            public = self.server.service.keys[0]
+            self._reply('application/json', json.dumps({
+                'session_key': "sessionkey",
+                'rsa_key': "keyname,%x,%x" % (public.n, public.e),
+            }))
+        elif self.path == "/Q":
+            self._reply('application/json', json.dumps({'result': {'verifier': "verifier"}}))
+        else:
+            self.send_error(404)
+
+    def _reply(self, content_type, data):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+class FakeLineServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for `FakeTalkService` on a free local port
+
+        >>> server = FakeLineServer(FakeTalkService()).start()
+        >>> server.url
+        'http://127.0.0.1:54321'
+    """
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), Handler)
+
+        self.service   = service
+        self.processor = CurveThrift.Processor(service)
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
@@ -13,6 +13,8 @@ from __future__ import absolute_import, unicode_literals
 import sys
 
 from .client import LineClient, LineGroup, LineContact
+from .poller import LinePoller
+from .metrics import Metrics
 
 __version__ = '0.0.8'
-__all__ = ['LineClient','LineGroup','LineContact']
+__all__ = ['LineClient','LineGroup','LineContact','LinePoller','Metrics']
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    line.broadcast
+    ~~~~~~~~~~~~~~
+
+    Sending one message to many recipients.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import copy
+import time
+import Queue
+import threading
+from binascii import hexlify
+
+from thrift.Thrift import TMessageType
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+
+from curve import CurveThrift
+from curve.ttypes import TalkException, ErrorCode
+
+THROTTLE_CODES = frozenset(getattr(ErrorCode, name)
+                           for name in ('EXCESSIVE_ACCESS',)
+                           if hasattr(ErrorCode, name))
+
+class MessageTemplate(object):
+    """`sendMessage` call serialized once, with only the recipient
+    swapped in per send.
+
+    The frame is written with a random placeholder of the recipient id's
+    length in the `to` field, so every recipient of that length reuses
+    the same bytes. Ids of other lengths get a template of their own.
+
+    :param message: Message instance, `to` is ignored
+    :param seq: (optional) `seq` argument of `sendMessage`
+    """
+    def __init__(self, message, seq=0):
+        self.message = copy.copy(message)
+        self.seq     = seq
+
+        self._frames = {}
+        self._lock   = threading.Lock()
+
+    def frame(self, to):
+        """Serialized `sendMessage` call for `to`"""
+        to = to.encode('utf-8')
+
+        template = self._frames.get(len(to))
+        if template is None:
+            with self._lock:
+                template = self._frames.get(len(to)) or self._build(len(to))
+                self._frames[len(to)] = template
+
+        frame, offset = template
+        return frame[:offset] + to + frame[offset + len(to):]
+
+    def _build(self, length):
+        while True:
+            placeholder = hexlify(os.urandom(length))[:length]
+
+            transport = TTransport.TMemoryBuffer()
+            protocol  = TCompactProtocol.TCompactProtocol(transport)
+
+            self.message.to = placeholder
+
+            protocol.writeMessageBegin('sendMessage', TMessageType.CALL, 0)
+            CurveThrift.sendMessage_args(seq=self.seq, message=self.message).write(protocol)
+            protocol.writeMessageEnd()
+
+            frame = transport.getvalue()
+
+            if frame.count(placeholder) == 1:
+                return frame, frame.index(placeholder)
+
+class RateController(object):
+    """Spaces out sends and adapts to throttling: the interval between
+    sends doubles whenever the server throttles and shrinks slowly while
+    sends succeed.
+
+    :param rate: (optional) sends per second to start with, None for
+                 no limit until the first throttle
+    """
+    min_interval = 0.001
+    backoff      = 2.0
+    recovery     = 0.95
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next send is allowed"""
+        with self._lock:
+            now  = time.time()
+            when = max(self._next, now)
+
+            self._next = when + self.interval
+
+        if when > now:
+            time.sleep(when - now)
+
+    def success(self):
+        with self._lock:
+            self.interval *= self.recovery
+
+            if self.interval < self.min_interval:
+                self.interval = 0.0
+
+    def throttled(self):
+        with self._lock:
+            self.interval = max(self.interval * self.backoff, self.min_interval * 10)
+            self._next = time.time() + self.interval
+
+def broadcast(client, ids, message, workers=8, rate=None, retries=3):
+    """Send `message` to every id in `ids`
+
+    :param client: LineClient instance
+    :param ids: list of `contact` id or `group` id
+    :param message: Message instance used as the template
+    :param workers: (optional) sends in flight at once
+    :param rate: (optional) initial sends per second
+    :param retries: (optional) attempts per recipient after a throttle
+    :returns: dict of id to the sent Message, or the exception that
+              stopped it
+    """
+    template   = MessageTemplate(message)
+    controller = RateController(rate)
+
+    tasks   = Queue.Queue()
+    results = {}
+
+    for id in ids:
+        tasks.put(id)
+
+    metrics = client.metrics
+
+    def send(id):
+        frame = template.frame(id)
+
+        with client._client.borrow() as thrift:
+            transport = thrift._oprot.trans
+
+            error = False
+            start = time.time()
+
+            try:
+                transport.write(frame)
+                transport.flush()
+
+                return thrift.recv_sendMessage()
+            except Exception:
+                error = True
+                raise
+            finally:
+                # the frame bypasses TInstrumentedClient, so record it here
+                if metrics is not None:
+                    metrics.record('sendMessage', time.time() - start,
+                                   getattr(transport, 'lastSent', 0),
+                                   getattr(transport, 'lastReceived', 0),
+                                   error)
+
+    def worker():
+        while True:
+            try:
+                id = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            for attempt in xrange(retries + 1):
+                controller.wait()
+
+                try:
+                    results[id] = send(id)
+                    controller.success()
+                    break
+                except TalkException as e:
+                    results[id] = e
+
+                    if e.code not in THROTTLE_CODES:
+                        break
+
+                    controller.throttled()
+                except Exception as e:
+                    results[id] = e
+                    break
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(workers, tasks.qsize()))]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
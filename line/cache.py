@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    line.cache
+    ~~~~~~~~~~
+
+    On-disk cache of LineClient state for warm starts, and small
+    in-memory LRU and TTL caches.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from thrift.Thrift import TType
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+from thrift.protocol.TProtocol import TProtocolException
+
+from curve.ttypes import Profile, Contact, Group
+
+MAGIC = b"LINE-STATE-1\n"
+
+class StateCache(object):
+    """Profile, contacts and groups of one account with the revision
+    they were valid at, stored as raw `TCompactProtocol` structs.
+
+    :param path: cache file, one per account
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """Load the cache
+
+        :returns: `(revision, profile, contacts, groups)` or None when
+                  there is no usable cache
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        if not data.startswith(MAGIC):
+            return None
+
+        transport = TTransport.TMemoryBuffer(data[len(MAGIC):])
+        protocol  = TCompactProtocol.TCompactProtocol(transport)
+
+        revision, profile, contacts, groups = None, None, [], []
+
+        try:
+            protocol.readStructBegin()
+            while True:
+                fname, ftype, fid = protocol.readFieldBegin()
+                if ftype == TType.STOP:
+                    break
+                elif fid == 1 and ftype == TType.I64:
+                    revision = protocol.readI64()
+                elif fid == 2 and ftype == TType.STRUCT:
+                    profile = Profile()
+                    profile.read(protocol)
+                elif fid == 3 and ftype == TType.LIST:
+                    contacts = self._readList(protocol, Contact)
+                elif fid == 4 and ftype == TType.LIST:
+                    groups = self._readList(protocol, Group)
+                else:
+                    protocol.skip(ftype)
+                protocol.readFieldEnd()
+            protocol.readStructEnd()
+        except (EOFError, TTransport.TTransportException, TProtocolException):
+            return None
+
+        if revision is None or profile is None:
+            return None
+
+        return revision, profile, contacts, groups
+
+    def save(self, revision, profile, contacts, groups):
+        """Replace the cache atomically
+
+        :param revision: revision `profile`, `contacts` and `groups` match
+        :param profile: Profile instance
+        :param contacts: list of Contact instance
+        :param groups: list of Group instance
+        """
+        transport = TTransport.TMemoryBuffer()
+        protocol  = TCompactProtocol.TCompactProtocol(transport)
+
+        protocol.writeStructBegin('LineState')
+
+        protocol.writeFieldBegin('revision', TType.I64, 1)
+        protocol.writeI64(revision)
+        protocol.writeFieldEnd()
+
+        protocol.writeFieldBegin('profile', TType.STRUCT, 2)
+        profile.write(protocol)
+        protocol.writeFieldEnd()
+
+        protocol.writeFieldBegin('contacts', TType.LIST, 3)
+        self._writeList(protocol, contacts)
+        protocol.writeFieldEnd()
+
+        protocol.writeFieldBegin('groups', TType.LIST, 4)
+        self._writeList(protocol, groups)
+        protocol.writeFieldEnd()
+
+        protocol.writeFieldStop()
+        protocol.writeStructEnd()
+
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            f.write(transport.getvalue())
+
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        """Remove the cache file"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _readList(self, protocol, cls):
+        items = []
+
+        etype, size = protocol.readListBegin()
+        for i in xrange(size):
+            item = cls()
+            item.read(protocol)
+            items.append(item)
+        protocol.readListEnd()
+
+        return items
+
+    def _writeList(self, protocol, items):
+        protocol.writeListBegin(TType.STRUCT, len(items))
+        for item in items:
+            item.write(protocol)
+        protocol.writeListEnd()
+
+class LRUCache(object):
+    """Thread-safe mapping that keeps the `maxsize` most recently used
+    items
+
+    :param maxsize: number of items kept
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+
+        self._items = OrderedDict()
+        self._lock  = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+
+            self._items[key] = value
+
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class TTLCache(object):
+    """Thread-safe mapping whose items expire `ttl` seconds after they
+    were put
+
+    :param ttl: seconds an item is kept
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+        self._items = {}
+        self._lock  = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items[key]
+            except KeyError:
+                return default
+
+            if expires < time.time():
+                del self._items[key]
+                return default
+
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.time() + self.ttl)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
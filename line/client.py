@@ -9,15 +9,20 @@
     :license: BSD, see LICENSE for more details.
 """
 from __future__ import unicode_literals
+import os
 import re
 import rsa
+import mmap
+import time
+import hashlib
+import Queue
 import requests
+import threading
 from datetime import datetime
+from collections import OrderedDict
 
 from thrift.transport import TTransport
 from thrift.transport import TSocket
-from thrift.transport import THttpClient
-from thrift.protocol import TCompactProtocol
 
 import sys
 reload(sys)
@@ -28,6 +33,15 @@ from curve import CurveThrift
 from curve.ttypes import TalkException
 from curve.ttypes import ToType, ContentType
 
+from .cache import StateCache, LRUCache, TTLCache
+from .broadcast import broadcast
+from .history import iterHistory, exportHistory
+from .journal import OperationJournal
+from .keystore import Keystore
+from .metrics import TInstrumentedClient
+from .replay import TrafficRecorder, TrafficReplay, TRecordingTransport
+from .transport import ConnectionPool, TPooledHttpClient, TClientMultiplexer, compactProtocol
+
 try:
     import simplejson as json
 except ImportError:
@@ -37,11 +51,47 @@ __all__ = ['LineClient']
 
 EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
 
-class LineMessage:
-    """LineMessage wrapper"""
+def _operationTypes(*names):
+    """Collect `OperationType` values, skipping names this curve lacks"""
+    OT = CurveThrift.OperationType
+
+    return frozenset(getattr(OT, name) for name in names if hasattr(OT, name))
+
+PROFILE_OPERATIONS = _operationTypes('UPDATE_PROFILE')
+
+CONTACT_ADD_OPERATIONS    = _operationTypes('ADD_CONTACT', 'UNBLOCK_CONTACT')
+CONTACT_REMOVE_OPERATIONS = _operationTypes('BLOCK_CONTACT')
+
+CONTACT_OPERATIONS = CONTACT_ADD_OPERATIONS | CONTACT_REMOVE_OPERATIONS | \
+    _operationTypes('NOTIFIED_UPDATE_PROFILE', 'UPDATE_CONTACT')
+
+GROUP_JOIN_OPERATIONS    = _operationTypes('CREATE_GROUP', 'ACCEPT_GROUP_INVITATION')
+GROUP_LEAVE_OPERATIONS   = _operationTypes('LEAVE_GROUP')
+GROUP_KICKOUT_OPERATIONS = _operationTypes('NOTIFIED_KICKOUT_FROM_GROUP')
+
+GROUP_OPERATIONS = GROUP_JOIN_OPERATIONS | GROUP_LEAVE_OPERATIONS | \
+    GROUP_KICKOUT_OPERATIONS | _operationTypes(
+    'UPDATE_GROUP', 'NOTIFIED_UPDATE_GROUP',
+    'INVITE_INTO_GROUP', 'NOTIFIED_INVITE_INTO_GROUP',
+    'NOTIFIED_LEAVE_GROUP', 'NOTIFIED_ACCEPT_GROUP_INVITATION',
+    'KICKOUT_FROM_GROUP', 'CANCEL_INVITATION_GROUP',
+    'NOTIFIED_CANCEL_INVITATION_GROUP', 'NOTIFIED_REJECT_GROUP_INVITATION')
+
+STATE_OPERATIONS = PROFILE_OPERATIONS | CONTACT_OPERATIONS | GROUP_OPERATIONS
+
+class LineMessage(object):
+    """LineMessage wrapper
+
+    `sender`, `receiver` and `createdTime` are resolved on first access.
+    """
+    __slots__ = ('_client', '_message', 'id', 'text', 'hasContent',
+                 'contentType', 'contentPreview', 'contentMetadata', 'toType',
+                 '_sender', '_receiver', '_createdTime')
 
     def __init__(self, client, message):
-        self._client = client
+        self._client  = client
+        self._message = message
+
         self.id   = message.id
         self.text = message.text
 
@@ -50,15 +100,35 @@ class LineMessage:
         self.contentPreview = message.contentPreview
         self.contentMetadata = message.contentMetadata
 
-        self.sender   = client.getContactOrGroupFromId(message._from)
-        self.receiver = client.getContactOrGroupFromId(message.to)
-
         # toType
         # 0: User
         # 1: Room
         # 2: Group
         self.toType = message.toType
-        self.createdTime = datetime.fromtimestamp(message.createdTime/1000)
+
+    @property
+    def sender(self):
+        try:
+            return self._sender
+        except AttributeError:
+            self._sender = self._client.getContactOrGroupFromId(self._message._from)
+            return self._sender
+
+    @property
+    def receiver(self):
+        try:
+            return self._receiver
+        except AttributeError:
+            self._receiver = self._client.getContactOrGroupFromId(self._message.to)
+            return self._receiver
+
+    @property
+    def createdTime(self):
+        try:
+            return self._createdTime
+        except AttributeError:
+            self._createdTime = datetime.fromtimestamp(self._message.createdTime/1000)
+            return self._createdTime
 
     def __repr__(self):
         return 'LineMessage (contentType=%s, sender=%s, receiver=%s) "%s"' % (
@@ -70,6 +140,8 @@ class LineMessage:
                 )
 
 class LineBase(object):
+    __slots__ = ('_client', 'id', 'messageBox')
+
     def sendMessage(self, text):
         try:
             message = CurveThrift.Message(to=self.id, text=text)
@@ -102,36 +174,30 @@ class LineBase(object):
             raise e
 
     def sendImage(self, path):
+        """Send a local image as its preview. The file is read through
+        mmap and its preview is cached by content hash"""
         try:
-            img = open(path, 'r')
-
-            message = CurveThrift.Message(to=self.id, text=text)
+            message = CurveThrift.Message(to=self.id, text=None)
             message.contentType = CurveThrift.ContentType.IMAGE
-            message.contentPreview = img.read().encode('utf-8')
-
-            self.raise_error("not implemented yet")
-
-            url = None
+            message.contentPreview = self._client._getImageFromFile(path)
 
             message.contentMetadata = {
-                'PREVIEW_URL': url,
-                'DOWNLOAD_URL': url,
-                'PUBLIC': True,
+                'PUBLIC': "True",
             }
 
-            self._client._sendMessage(message)
+            self._client._sendMessage(message, seq=1)
 
             return True
         except Exception as e:
             raise e
 
     def sendImageWithURL(self, url):
+        """Send an image by url. The download is streamed, capped at
+        `image_max_size` and cached by url"""
         try:
-            response = requests.get(url, stream=True)
-
             message = CurveThrift.Message(to=self.id, text=None)
             message.contentType = CurveThrift.ContentType.IMAGE
-            message.contentPreview = response.raw.read()
+            message.contentPreview = self._client._getImageFromURL(url)
             #message.contentPreview = url.encode('utf-8')
 
             message.contentMetadata = {
@@ -154,17 +220,34 @@ class LineBase(object):
         return message_list
 
     def getRecentMessages(self, count=1):
-        """Get recent messages"""
+        """Get recent messages. On failure the message box is looked up
+        again, bypassing the cache, and the call is retried once"""
         try:
-            messages = self._client._getRecentMessages(self.messageBox.id, count)
+            messages = self._client._getRecentMessages(self._getMessageBoxId(), count)
+        except Exception:
+            messages = self._client._getRecentMessages(self._getMessageBoxId(refresh=True), count)
 
-            return self._getLineMessageListFromMessageList(messages)
-        except:
-            self.messageBox = self._client.getMessageBox(self.id)
+        return self._getLineMessageListFromMessageList(messages)
+
+    def _getMessageBoxId(self, refresh=False):
+        self.messageBox = self._client.getMessageBox(self.id, refresh)
+
+        return self.messageBox.id if self.messageBox else self.id
 
-            messages = self._client._getRecentMessages(self.messageBox.id, count)
+    def iterHistory(self, pageSize=100):
+        """Iterate over all messages from newest to oldest, fetching
+        `pageSize` at a time"""
+        for message in iterHistory(self._client, self._getMessageBoxId(), pageSize=pageSize):
+            yield LineMessage(self._client, message)
 
-            return self._getLineMessageListFromMessageList(messages)
+    def exportHistory(self, path, format='jsonl', cursorPath=None, pageSize=100):
+        """Append all messages to `path` as JSON lines or compact Thrift
+        structs, resumable through `cursorPath`
+
+        :returns: number of messages written
+        """
+        return exportHistory(self._client, self._getMessageBoxId(), path,
+                             format, cursorPath, pageSize)
 
     def __lt__(self, other):
         return self.id < other.id
@@ -177,9 +260,15 @@ class LineGroup(LineBase):
         members     list of contact of group members
         invitee     list of contact of group invitee
     """
+    __slots__ = ('_group', 'name')
+
     def __init__(self, client, group):
         """LineGroup init
 
+        Member data is interned in the client's contact registry, so a
+        user in many groups is stored once. `creator`, `members` and
+        `invitee` are resolved from the registry on access.
+
         :param client: LineClient instance
         :param group: Group instace
         """
@@ -190,19 +279,31 @@ class LineGroup(LineBase):
         self.id      = group.id
         self.name    = group.name
 
-        try:
-            self.creator = LineContact(client, group.creator)
-        except:
-            self.creator = None
+        if group.creator:
+            group.creator = client._internMember(group.creator)
 
-        self.members = []
-        for member in group.members:
-            self.members.append(LineContact(client, member))
+        if group.members:
+            group.members = [client._internMember(member)
+                             for member in group.members]
 
-        self.invitee = []
         if group.invitee:
-            for member in group.invitee:
-                self.invitee.append(LineContact(client, member))
+            group.invitee = [client._internMember(member)
+                             for member in group.invitee]
+
+    @property
+    def creator(self):
+        if self._group.creator:
+            return self._client._internContact(self._group.creator)
+
+    @property
+    def members(self):
+        return [self._client._internContact(member)
+                for member in self._group.members or []]
+
+    @property
+    def invitee(self):
+        return [self._client._internContact(member)
+                for member in self._group.invitee or []]
 
     def leaveGroup(self):
         """Leave group"""
@@ -214,7 +315,7 @@ class LineGroup(LineBase):
 
     def __repr__(self):
         """Name of Group and number of group members"""
-        return '<LineGroup %s #%s>' % (self.name, len(self.members))
+        return '<LineGroup %s #%s>' % (self.name, len(self._group.members or []))
 
 class LineContact(LineBase):
     """LineContact wrapper
@@ -223,6 +324,8 @@ class LineContact(LineBase):
         name            display name of contact
         statusMessage   status message of contact
     """
+    __slots__ = ('_contact', 'name', 'statusMessage')
+
     def __init__(self, client, contact):
         """LineContact init
 
@@ -231,9 +334,13 @@ class LineContact(LineBase):
         """
 
         self._client  = client
+        self.id = contact.mid
+        self._update(contact)
+
+    def _update(self, contact):
+        """Replace the Contact data behind this wrapper"""
         self._contact = contact
 
-        self.id            = contact.mid
         self.name          = contact.displayName
         self.statusMessage = contact.statusMessage
 
@@ -263,16 +370,49 @@ class LineClient(object):
     version     = "5.9.2"
     com_name    = ""
 
-    revision = 0
-    profile  = None
-    contacts = []
-    rooms    = []
-    groups   = []
+    chunk_size      = 200
+    refresh_workers = 4
+
+    cache_max_gap       = 1000
+    cache_save_interval = 60
+
+    pool_size         = 4
+    pool_idle_timeout = 60
+
+    image_max_size     = 10 * 1024 * 1024
+    preview_cache_size = 32
+
+    message_box_ttl     = 300
+    message_box_workers = 8
+
+    print_operations = False
+
+    # decode with thrift's C compact protocol when it is installed
+    accelerated = False
+
+    authToken   = None
+    certificate = None
+    rooms       = []
 
-    _session = requests.session()
-    _headers = {}
+    _cache    = None
+    _replay   = None
+    _recorder = None
+    _journal  = None
+    _keystore = None
+    _revision = None
+    _profile  = None
+    _contacts = None
+    _groups   = None
 
-    def __init__(self, id=None, password=None, authToken=None, is_mac=True, com_name="GetLineApiAuthToken"):
+    _contactNames = None
+    _groupNames   = None
+    _contactList  = None
+    _groupList    = None
+
+    _cacheTried   = False
+    _cacheSavedAt = 0
+
+    def __init__(self, id=None, password=None, authToken=None, is_mac=True, com_name="GetLineApiAuthToken", lazy=False, cache=None, pool=None, session=None, keystore=None, journal=None, metrics=None, record=None, replay=None, accelerated=None):
         """Initialize LINE instance with provided information
 
         :param id: `NAVER id` or `LINE email`
@@ -280,12 +420,80 @@ class LineClient(object):
         :param authToken: LINE session key
         :param is_mac: (optional) os setting
         :param com_name: (optional) name of your system
+        :param lazy: (optional) return as soon as `authToken` is known and
+                     defer transports, revision, contacts and groups
+                     until they are first used
+        :param cache: (optional) path of a state cache file for this
+                      account, used for warm starts. `longPoll` saves it
+                      every `cache_save_interval` seconds and `close`
+                      saves it on the way out. A `lazy` client loads it
+                      when its profile, contacts or groups are first used
+        :param pool: (optional) ConnectionPool to share with other clients
+        :param session: (optional) `requests` session to share with other
+                        clients; headers are still sent per client
+        :param keystore: (optional) Keystore or path of one. A stored
+                         authToken that still works is used instead of
+                         logging in, and a stored certificate lets the
+                         login skip the PinCode
+        :param journal: (optional) OperationJournal or path of one.
+                        `longPoll` and `LinePoller` record what was
+                        handled there, and polling resumes from its
+                        checkpoint after a restart
+        :param metrics: (optional) Metrics instance recording every RPC
+                        and `get_json` request
+        :param record: (optional) TrafficRecorder or path to append the
+                       raw Thrift traffic of this client to
+        :param replay: (optional) TrafficReplay or path of a recording
+                       to answer Thrift calls from instead of the server;
+                       use it with `authToken`
+        :param accelerated: (optional) decode with thrift's C compact
+                            protocol when it is installed, overriding
+                            the `accelerated` class attribute
         """
 
         if not (authToken or id and password):
             msg = "id and password or authToken is needed"
             self.raise_error(msg)
 
+        self.refreshTimings = {}
+        self.metrics        = metrics
+
+        if accelerated is not None:
+            self.accelerated = accelerated
+
+        self._handlers = {}
+        self._filters  = {}
+        self.previewCache   = LRUCache(self.preview_cache_size)
+        self.messageBoxes   = TTLCache(self.message_box_ttl)
+        self._registry = {}
+
+        self.pool     = pool or ConnectionPool(self.pool_size, self.pool_idle_timeout)
+        self._session = session or requests.session()
+        self._headers = {}
+
+        if cache:
+            self._cache = StateCache(cache)
+
+        if isinstance(journal, basestring):
+            self._journal = OperationJournal(journal)
+        elif journal:
+            self._journal = journal
+
+        if isinstance(record, basestring):
+            self._recorder = TrafficRecorder(record)
+        elif record:
+            self._recorder = record
+
+        if isinstance(replay, basestring):
+            self._replay = TrafficReplay(replay)
+        elif replay:
+            self._replay = replay
+
+        if isinstance(keystore, basestring):
+            self._keystore = Keystore(keystore)
+        elif keystore:
+            self._keystore = keystore
+
         if is_mac:
             os_version = "10.9.4-MAVERICKS-x64"
             user_agent = "DESKTOP:MAC:%s(%s)" % (os_version, self.version)
@@ -303,8 +511,6 @@ class LineClient(object):
 
         if authToken:
             self.authToken = self._headers['X-Line-Access'] = authToken
-
-            self.ready()
         else:
             if EMAIL_REGEX.match(id):
                 self.provider = CurveThrift.Provider.LINE # LINE
@@ -315,32 +521,187 @@ class LineClient(object):
             self.password = password
             self.is_mac = is_mac
 
-            self.login()
+            if self._keystore:
+                entry = self._keystore.get(id)
+                self.certificate = entry.get('certificate')
+
+                if not (entry.get('authToken') and self.checkAuthToken(entry['authToken'])):
+                    self.login()
+
+                self._keystore.put(id, self.authToken, self.certificate)
+            else:
+                self.login()
+
+        if not lazy:
             self.ready()
 
-        self.revision = self._getLastOpRevision()
-        self.refreshContacts()
-        self.refreshGroups()
+            if not self._loadCache():
+                self.revision = self._getLastOpRevision()
+                self.refreshContacts()
+                self.refreshGroups()
+
+            if self._cache:
+                self.saveCache()
+
+        if self._journal and self._journal.revision is not None:
+            # resume where the handlers stopped, not at the server's head
+            self.revision = self._journal.revision
+
+    def loadCache(self):
+        """Load state from the cache and catch up with the server by
+        applying the operations since the cached revision
+
+        :returns: False if there is no cache or it is more than
+                  `cache_max_gap` revisions behind
+        """
+        self._cacheTried = True
+
+        state = self._cache.load()
+        if state is None:
+            return False
+
+        revision, profile, contacts, groups = state
+        last_revision = self._getLastOpRevision()
+
+        if last_revision - revision > self.cache_max_gap:
+            return False
+
+        self._contacts     = {}
+        self._contactNames = {}
+        self._contactList  = None
+
+        for contact in contacts:
+            self._indexContact(self._internContact(contact, update=True))
+
+        self._profile = self._internContact(profile, update=True)
+        self._indexContact(self._profile)
+
+        self._groups     = {}
+        self._groupNames = {}
+        self._groupList  = None
+
+        for group in groups:
+            self._indexGroup(LineGroup(self, group))
+
+        while revision < last_revision:
+            previous   = revision
+            operations = self._fetchOperations(revision, 100)
+
+            for operation in operations:
+                self._applyOperation(operation)
+                revision = max(operation.revision, revision)
+
+            if revision == previous:
+                break
+
+        # a lazy client may already be polling from a revision of its own
+        if self._revision is None:
+            self.revision = max(revision, last_revision)
+
+        return True
+
+    def saveCache(self):
+        """Write profile, contacts and groups with the current revision
+        to the cache"""
+        if self._cache and self._contacts is not None and self._groups is not None:
+            profile  = self._profile
+            contacts = [contact._contact for contact in self._contacts.itervalues()
+                        if contact is not profile]
+            groups   = [group._group for group in self._groups.itervalues()]
+
+            self._cache.save(self.revision, profile._contact, contacts, groups)
+
+        self._cacheSavedAt = time.time()
+
+    def close(self):
+        """Save the cache and make the journal and recording durable"""
+        if self._cache:
+            self.saveCache()
+
+        if self._journal:
+            self._journal.close()
+
+        if self._recorder:
+            self._recorder.close()
+
+    def _loadCache(self):
+        """Load the cache once, if the client has one
+
+        :returns: True if state was loaded from it
+        """
+        if not self._cache or self._cacheTried:
+            return False
+
+        return self.loadCache()
+
+    def __getattr__(self, name):
+        """Build the transports of a `lazy` client on first use"""
+        if name in ('_client', '_client_in', 'transport', 'transport_in',
+                    'protocol', 'protocol_in') and self.authToken:
+            self.ready()
+            return object.__getattribute__(self, name)
+
+        raise AttributeError(name)
+
+    @property
+    def revision(self):
+        if self._revision is None:
+            self._revision = self._getLastOpRevision()
+
+        return self._revision
+
+    @revision.setter
+    def revision(self, revision):
+        self._revision = revision
+
+    @property
+    def profile(self):
+        if self._profile is None and not self._loadCache():
+            self.refreshContacts()
+
+        return self._profile
+
+    @property
+    def contacts(self):
+        """Sorted list of contacts, built from the id index on demand"""
+        if self._contacts is None and not self._loadCache():
+            self.refreshContacts()
+
+        if self._contactList is None:
+            self._contactList = sorted(self._contacts.itervalues())
+
+        return self._contactList
+
+    @property
+    def groups(self):
+        """Sorted list of groups, built from the id index on demand"""
+        if self._groups is None and not self._loadCache():
+            self.refreshGroups()
+
+        if self._groupList is None:
+            self._groupList = sorted(self._groups.itervalues())
+
+        return self._groupList
 
     def ready(self):
         """
         After login, make `client` and `client_in` instance
         to communicate with LINE server
-        """
-        self.transport    = THttpClient.THttpClient(self.LINE_HTTP_URL)
-        self.transport_in = THttpClient.THttpClient(self.LINE_HTTP_IN_URL)
 
-        self.transport.setCustomHeaders(self._headers)
-        self.transport_in.setCustomHeaders(self._headers)
+        `client` is safe to share between threads; every concurrent
+        call gets a transport of its own.
+        """
+        self.transport    = self._newTransport(self.LINE_HTTP_URL)
+        self.transport_in = self._newTransport(self.LINE_HTTP_IN_URL)
 
-        self.protocol    = TCompactProtocol.TCompactProtocol(self.transport)
-        self.protocol_in = TCompactProtocol.TCompactProtocol(self.transport_in)
+        self.protocol    = self._newProtocol(self.transport)
+        self.protocol_in = self._newProtocol(self.transport_in)
 
-        self._client    = CurveThrift.Client(self.protocol)
-        self._client_in = CurveThrift.Client(self.protocol_in)
+        self._client    = TClientMultiplexer(
+                lambda: self._newClient(self.LINE_HTTP_URL))
+        self._client_in = self._wrapClient(CurveThrift.Client(self.protocol_in))
 
-        self.transport.open()
-        self.transport_in.open()
+        self._client.checkin(self._wrapClient(CurveThrift.Client(self.protocol)))
 
     def login(self):
         """Login to LINE server."""
@@ -358,26 +719,27 @@ class LineClient(object):
         pub_key       = rsa.PublicKey(int(n,16), int(e,16))
         crypto        = rsa.encrypt(message, pub_key).encode('hex')
 
-        self.transport = THttpClient.THttpClient(self.LINE_HTTP_URL)
-        self.transport.setCustomHeaders(self._headers)
-
-        self.protocol = TCompactProtocol.TCompactProtocol(self.transport)
-        self._client   = CurveThrift.Client(self.protocol)
+        client = self._newClient(self.LINE_HTTP_URL)
 
-        msg = self._client.loginWithIdentityCredentialForCertificate(
+        msg = client.loginWithIdentityCredentialForCertificate(
                 self.id, self.password, keyname, crypto, False, self.ip,
-                self.com_name, self.provider, "")
+                self.com_name, self.provider, self.certificate or "")
+
+        if msg.type == 1 and msg.authToken:
+            # a known certificate logs in without a PinCode
+            self.certificate = msg.certificate or self.certificate
+            self.authToken = self._headers['X-Line-Access'] = msg.authToken
+            return
         
         self._headers['X-Line-Access'] = msg.verifier
         self._pinCode = msg.pinCode
 
-        print "Enter PinCode '%s' to your mobile phone in 2 minutes"\
-                % self._pinCode
+        self.showPinCode(self._pinCode)
 
         j = self.get_json(self.LINE_CERTIFICATE_URL)
         self.verifier = j['result']['verifier']
 
-        msg = self._client.loginWithVerifierForCertificate(self.verifier)
+        msg = client.loginWithVerifierForCertificate(self.verifier)
 
         if msg.type == 1:
             self.certificate = msg.certificate
@@ -389,117 +751,641 @@ class LineClient(object):
             msg = "require device confirm"
             self.raise_error(msg)
 
-    def refreshGroups(self):
-        """Refresh groups of LineClient """
+    def checkAuthToken(self, authToken):
+        """Use `authToken` if one `getLastOpRevision` call accepts it
+
+        :returns: True if `authToken` is valid
+        """
+        self._headers['X-Line-Access'] = authToken
+
+        try:
+            revision = self._newClient(self.LINE_HTTP_URL).getLastOpRevision()
+        except TalkException:
+            del self._headers['X-Line-Access']
+            return False
+
+        self.authToken = authToken
+        self._revision = revision
+
+        return True
+
+    def showPinCode(self, pinCode):
+        """Tell the user which PinCode to enter. Override to show it
+        somewhere other than stdout"""
+        print "Enter PinCode '%s' to your mobile phone in 2 minutes"\
+                % pinCode
+
+    def refreshGroups(self, chunk_size=None):
+        """Refresh groups of LineClient
+
+        :param chunk_size: (optional) number of groups per `getGroups` call
+        """
         if self.check_auth():
             group_ids = self._getGroupIdsJoined()
-            groups    = self._getGroups(group_ids)
 
-            self.groups = []
+            groups = {}
+            names  = {}
+            timings = []
+
+            for offset, chunk, seconds in self._fetchChunked('getGroups', group_ids, chunk_size):
+                for group in chunk:
+                    self._index(groups, names, LineGroup(self, group))
 
-            for group in groups:
-                self.groups.append(LineGroup(self, group))
+                timings.append((offset, len(chunk), seconds))
 
-            self.groups.sort()
+            self._groups     = groups
+            self._groupNames = names
+            self._groupList  = None
+
+            self.refreshTimings['groups'] = sorted(timings)
 
     def refreshRooms(self):
-        """Refresh rooms. Need to be called after `refreshContacts`"""
+        """Refresh the message boxes of contacts. Need to be called after
+        `refreshContacts`"""
         if self.check_auth():
-            for contact in self.contacts:
-                messageBox = self.getMessageBox(contact.id)
+            contacts = self.contacts
+            boxes    = self.getMessageBoxes([contact.id for contact in contacts], refresh=True)
+
+            for contact in contacts:
+                contact.messageBox = boxes.get(contact.id)
+
+    def refreshContacts(self, chunk_size=None):
+        """Refresh contacts of LineClient
 
-    def refreshContacts(self):
-        """Refresh contacts of LineClient """
+        :param chunk_size: (optional) number of contacts per `getContacts` call
+        """
         if self.check_auth():
             contact_ids = self._getAllContactIds()
-            contacts    = self._getContacts(contact_ids)
 
-            self.contacts = []
+            contacts = {}
+            names    = {}
+            timings  = []
 
-            for contact in contacts:
-                self.contacts.append(LineContact(self, contact))
+            for offset, chunk, seconds in self._fetchChunked('getContacts', contact_ids, chunk_size):
+                for contact in chunk:
+                    self._index(contacts, names, self._internContact(contact, update=True))
+
+                timings.append((offset, len(chunk), seconds))
+
+            self._profile = self._internContact(self._getProfile(), update=True)
+            self._index(contacts, names, self._profile)
+
+            self._contacts     = contacts
+            self._contactNames = names
+            self._contactList  = None
+
+            self.refreshTimings['contacts'] = sorted(timings)
+
+    def _newTransport(self, url):
+        """Make an open transport to `url` on the client's connection pool"""
+        if self._replay:
+            return self._replay.transport(url)
+
+        transport = TPooledHttpClient(url, self.pool)
+        transport.setCustomHeaders(self._headers)
+        transport.open()
+
+        if self._recorder:
+            return TRecordingTransport(transport, self._recorder)
+
+        return transport
+
+    def _newClient(self, url):
+        """Make a `CurveThrift.Client` on a transport of its own"""
+        transport = self._newTransport(url)
+
+        return self._wrapClient(CurveThrift.Client(self._newProtocol(transport)))
+
+    def _newProtocol(self, transport):
+        """Make the compact protocol of `transport`, accelerated when
+        `accelerated` is set and thrift's C extension is available"""
+        return compactProtocol(transport, self.accelerated)
+
+    def _wrapClient(self, client):
+        """Instrument `client` when the client keeps metrics"""
+        if self.metrics is None:
+            return client
+
+        return TInstrumentedClient(client, self.metrics)
+
+    def _fetchChunked(self, method, ids, chunk_size=None):
+        """Call `method` of the Thrift client over chunks of `ids`.
+
+        Chunks are spread over up to `refresh_workers` threads sharing the
+        multiplexed `_client`, and yielded as `(offset, result, seconds)` in
+        the order they complete so callers can work on early chunks while
+        later ones are still in flight.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        chunks = [(offset, ids[offset:offset + chunk_size])
+                  for offset in xrange(0, len(ids), chunk_size)]
+
+        if len(chunks) <= 1 or self.refresh_workers <= 1:
+            for offset, chunk in chunks:
+                start = time.time()
+                result = getattr(self._client, method)(chunk)
+
+                yield offset, result, time.time() - start
+
+            return
+
+        tasks   = Queue.Queue()
+        results = Queue.Queue()
+
+        for task in chunks:
+            tasks.put(task)
+
+        def worker():
+            while True:
+                try:
+                    offset, chunk = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+
+                start = time.time()
+                try:
+                    result = getattr(self._client, method)(chunk)
+                    results.put((offset, result, time.time() - start, None))
+                except Exception as e:
+                    results.put((offset, None, time.time() - start, e))
+
+        for i in xrange(min(self.refresh_workers, len(chunks))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        for i in xrange(len(chunks)):
+            offset, result, seconds, error = results.get()
+
+            if error is not None:
+                raise error
+
+            yield offset, result, seconds
+
+    def _internContact(self, contact, update=False):
+        """Get the one LineContact for `contact.mid` from the registry
+
+        :param contact: Contact or Profile instance
+        :param update: (optional) replace the data of an existing wrapper
+        """
+        wrapper = self._registry.get(contact.mid)
+
+        if wrapper is None:
+            wrapper = self._registry[contact.mid] = LineContact(self, contact)
+        elif update:
+            wrapper._update(contact)
+
+        return wrapper
 
-            self.profile = LineContact(self, self._getProfile())
+    def _internMember(self, contact):
+        """Intern a group member and return the shared Contact data"""
+        shared = self._internContact(contact)._contact
 
-            self.contacts.append(self.profile)
-            self.contacts.sort()
+        # the own profile is registered with a Profile, not a Contact
+        if type(shared) is not type(contact):
+            return contact
+
+        return shared
+
+    def _index(self, index, names, item):
+        """Put `item` into an id index and its name index.
+
+        When two items share a name, the one with the smaller id wins,
+        which is the one a scan of the sorted list would find first.
+        """
+        index[item.id] = item
+
+        other = names.get(item.name)
+        if other is None or other.id == item.id or item.id < other.id:
+            names[item.name] = item
+
+    def _unindex(self, index, names, id):
+        """Drop `id` from an id index and its name index"""
+        item = index.pop(id, None)
+
+        if item is not None and names.get(item.name) is item:
+            del names[item.name]
+
+            for other in index.itervalues():
+                if other.name == item.name:
+                    self._index(index, names, other)
+
+        return item
+
+    def _indexContact(self, contact):
+        self._index(self._contacts, self._contactNames, contact)
+        self._contactList = None
+
+    def _unindexContact(self, id):
+        self._contactList = None
+        return self._unindex(self._contacts, self._contactNames, id)
+
+    def _indexGroup(self, group):
+        self._index(self._groups, self._groupNames, group)
+        self._groupList = None
+
+    def _unindexGroup(self, id):
+        self._groupList = None
+        return self._unindex(self._groups, self._groupNames, id)
 
     def getContactFromId(self, id):
-        for contact in self.contacts:
-            if contact.id == id:
-                return contact
+        if self._contacts is None and not self._loadCache():
+            self.refreshContacts()
 
-        return None
+        return self._contacts.get(id)
 
     def getGroupFromName(self, name):
-        for group in self.groups:
-            if name == group.name:
-                return group
+        if self._groups is None and not self._loadCache():
+            self.refreshGroups()
 
-        return None
+        return self._groupNames.get(name)
 
     def getContactFromName(self, name):
-        for contact in self.contacts:
-            if name == contact.name:
-                return contact
+        if self._contacts is None and not self._loadCache():
+            self.refreshContacts()
 
-        return None
+        return self._contactNames.get(name)
 
     def getGroupFromId(self, id):
-        for group in self.groups:
-            if group.id == id:
-                return group
+        if self._groups is None and not self._loadCache():
+            self.refreshGroups()
 
-        return None
+        return self._groups.get(id)
 
     def getContactOrGroupFromId(self, id):
-        for contact in self.contacts:
-            if contact.id == id:
-                return contact
+        return self.getContactFromId(id) or self.getGroupFromId(id)
 
-        for group in self.groups:
-            if group.id == id:
-                return group
+    def getMessageBox(self, id, refresh=False):
+        """Get the message box of a contact, group or room, cached for
+        `message_box_ttl` seconds
 
-        return None
+        :param id: id of the contact, group or room
+        :param refresh: (optional) fetch it even when it is cached
+        :returns: MessageBox, or None when it could not be fetched
+        """
+        if not refresh:
+            messageBox = self.messageBoxes.get(id)
+            if messageBox is not None:
+                return messageBox
 
-    def getMessageBox(self, id):
         try:
-            messageBoxWrapUp = self._client._getMessageBoxCompactWrapUp(self.id)
-
-            return messageBoxWrapUp.messageBox
-        except:
+            messageBox = self._getMessageBoxCompactWrapUp(id).messageBox
+        except Exception:
+            self.messageBoxes.discard(id)
             return None
 
-    def longPoll(self, count=50):
-        """Check is there any operations from LINE server"""
-        OT = CurveThrift.OperationType
+        self.messageBoxes.put(id, messageBox)
+
+        return messageBox
+
+    def getMessageBoxes(self, ids, refresh=False):
+        """Get the message boxes of many ids. Those not cached are
+        fetched over up to `message_box_workers` threads sharing the
+        multiplexed `_client`
+
+        :param ids: list of contact, group or room id
+        :param refresh: (optional) fetch them even when they are cached
+        :returns: dict of id to MessageBox, without the ids that failed
+        """
+        boxes   = {}
+        missing = []
+
+        for id in ids:
+            messageBox = None if refresh else self.messageBoxes.get(id)
+
+            if messageBox is None:
+                missing.append(id)
+            else:
+                boxes[id] = messageBox
+
+        tasks = Queue.Queue()
+        for id in missing:
+            tasks.put(id)
+
+        def worker():
+            while True:
+                try:
+                    id = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+
+                messageBox = self.getMessageBox(id, refresh=True)
+                if messageBox is not None:
+                    boxes[id] = messageBox
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(min(self.message_box_workers, len(missing)))]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
 
+        for thread in threads:
+            thread.join()
+
+        return boxes
+
+    def addHandler(self, type, handler, filter=None, batch=False):
+        """Call `handler` for every operation of `type` seen by `longPoll`
+
+        :param type: `CurveThrift.OperationType` value
+        :param handler: callable taking the Operation, or with `batch`
+                        the list of Operations of `type` in one fetch
+        :param filter: (optional) callable taking the Operation; the
+                       handler only gets operations it returns True for
+        :param batch: (optional) collect a fetch's operations for one call
+        """
+        self._handlers.setdefault(type, []).append((handler, filter, batch))
+
+    def removeHandler(self, type, handler):
+        """Stop calling `handler` for operations of `type`"""
+        self._handlers[type] = [entry for entry in self._handlers.get(type, [])
+                                if entry[0] != handler]
+
+    def setFilter(self, type, filter):
+        """Drop operations of `type` for which `filter` returns False
+        before any handler runs or wrapper is built. Contact and group
+        state is still kept up to date. Pass None to remove the filter.
+        """
+        if filter is None:
+            self._filters.pop(type, None)
+        else:
+            self._filters[type] = filter
+
+    def dispatch(self, count=50):
+        """Fetch one batch of operations for the registered handlers,
+        discarding the events `longPoll` yields"""
+        for event in self.longPoll(count):
+            pass
+
+    def longPoll(self, count=50, record=None):
+        """Check is there any operations from LINE server
+
+        Fetches up to `count` operations and yields the events of
+        `dispatchOperations` for them.
+
+        :param count: (optional) operations per `fetchOperations`
+        :param record: (optional) see `dispatchOperations`
+        """
         try:
             operations = self._client_in.fetchOperations(self.revision, count)
         except EOFError:
             return
         except TalkException as e:
             if e.code == 9:
-                raise_error("user logged in to another machien")
+                self.raise_error("user logged in to another machien")
             else:
                 return
 
-        for operation in operations:
-            if operation.type == OT.END_OF_OPERATION:
+        events = self.dispatchOperations(operations, record)
+
+        try:
+            for event in events:
+                yield event
+        finally:
+            events.close()
+
+    def dispatchOperations(self, operations, record=None):
+        """Run fetched operations through filters, handlers and actions
+
+        Each operation goes through its type's filter and handlers, then
+        the built-in action of its type: RECEIVE_MESSAGE is yielded as
+        `(LineContact|LineGroup, LineMessage)`, contact and group events
+        update the indexes, and anything else is dropped (or printed
+        with `print_operations`). Batch handlers get their operations
+        when the fetched batch is done, or when the consumer stops early.
+        If a batch handler raises, the revision goes back to before the
+        first batched operation, so all operations from there on are
+        fetched again.
+
+        With a journal, an operation is recorded once the consumer asks
+        for the next event, and the whole batch is committed at the end,
+        so after a crash only uncommitted operations are delivered again.
+        This holds when the consumer handles each event before asking for
+        the next; one that hands events on, like `LinePoller`, passes
+        `record` and records them itself once they are handled. A batched
+        operation, and every operation after it, is recorded only once
+        its batch handler has returned.
+
+        :param operations: list of Operation from `fetchOperations`
+        :param record: (optional) callable taking each Operation in place
+                       of the journal's `record`; the journal is then
+                       not committed either
+        """
+        OT = CurveThrift.OperationType
+        journal  = self._journal
+        handlers = self._handlers
+        filters  = self._filters
+        batches  = []
+        deferred = []
+        resume   = None
+
+        try:
+            for operation in operations:
+                if journal and journal.isProcessed(operation.revision):
+                    continue
+
+                type    = operation.type
+                filter  = filters.get(type)
+                pending = []
+
+                if filter is None or filter(operation):
+                    for entry in handlers.get(type, ()):
+                        handler, accept, batch = entry
+                        if accept is None or accept(operation):
+                            if batch:
+                                pending.append((id(entry), entry, operation))
+                            else:
+                                handler(operation)
+
+                    action = self._actions.get(type)
+                    if action is not None:
+                        event = action(self, operation)
+                        if event is not None:
+                            yield event
+                    elif self.print_operations:
+                        print "[*] %s" % OT._VALUES_TO_NAMES.get(type, type)
+                        print operation
+                elif type in STATE_OPERATIONS:
+                    self._applyOperation(operation)
+
+                if pending and not deferred:
+                    resume = self.revision
+
+                self.revision = max(operation.revision, self.revision)
+
+                # the journal must not get ahead of a batch handler, so from
+                # the first batched operation on, records wait for delivery
+                if pending or deferred:
+                    deferred.append(operation)
+                elif record is not None:
+                    record(operation)
+                elif journal:
+                    journal.record(operation)
+
+                # batched only once the revision is past the operation, so
+                # one left behind by a consumer that stopped is fetched again
+                batches.extend(pending)
+        finally:
+            try:
+                # delivered even when the consumer stops early, as the
+                # revision has already moved past these operations. Groups
+                # are keyed by registration, which `removeHandler` can not
+                # shift; `batches` holds the entries, keeping ids unique
+                if batches:
+                    grouped = OrderedDict()
+                    for key, entry, operation in batches:
+                        grouped.setdefault(key, (entry[0], []))[1].append(operation)
+
+                    for handler, batch in grouped.itervalues():
+                        handler(batch)
+            except Exception:
+                self.revision = resume
+                raise
+            else:
+                for operation in deferred:
+                    if record is not None:
+                        record(operation)
+                    elif journal:
+                        journal.record(operation)
+            finally:
+                if journal and record is None:
+                    journal.commit()
+
+                if self._cache and time.time() - self._cacheSavedAt >= self.cache_save_interval:
+                    self.saveCache()
+
+    def _receiveMessage(self, operation):
+        message = LineMessage(self, operation.message)
+        group_or_contact = self.getContactOrGroupFromId(operation.message.to)
+
+        return (group_or_contact, message)
+
+    def _ignoreOperation(self, operation):
+        return None
+
+    def _syncOperation(self, operation):
+        self._applyOperation(operation)
+
+    # built-in action per operation type, see `longPoll`
+    _actions = dict.fromkeys(STATE_OPERATIONS, _syncOperation)
+    _actions.update({
+        CurveThrift.OperationType.END_OF_OPERATION: _ignoreOperation,
+        CurveThrift.OperationType.SEND_MESSAGE: _ignoreOperation,
+        CurveThrift.OperationType.RECEIVE_MESSAGE: _receiveMessage,
+    })
+
+    def _applyOperation(self, operation):
+        """Apply a contact, profile or group operation to the indexes
+
+        :returns: True if `operation` changes contact or group state
+        """
+        type = operation.type
+
+        if type in PROFILE_OPERATIONS:
+            if self._profile is not None:
+                self._unindexContact(self._profile.id)
+                self._profile = self._internContact(self._getProfile(), update=True)
+                self._indexContact(self._profile)
+        elif type in CONTACT_OPERATIONS:
+            if self._contacts is not None:
+                removed = type in CONTACT_REMOVE_OPERATIONS
+                added   = type in CONTACT_ADD_OPERATIONS
+
+                if removed or added or operation.param1 in self._contacts:
+                    self._syncContact(operation.param1, removed)
+        elif type in GROUP_OPERATIONS:
+            if self._groups is not None:
+                left = type in GROUP_LEAVE_OPERATIONS or \
+                       (type in GROUP_KICKOUT_OPERATIONS and
+                        self._profile is not None and
+                        operation.param3 == self._profile.id)
+                joined = type in GROUP_JOIN_OPERATIONS
+
+                if left or joined or operation.param1 in self._groups:
+                    self._syncGroup(operation.param1, left)
+        else:
+            return False
+
+        return True
+
+    def _syncContact(self, id, removed=False):
+        """Re-fetch one contact into the indexes, or drop it"""
+        self._unindexContact(id)
+
+        if not removed:
+            try:
+                for contact in self._client.getContacts([id]):
+                    self._indexContact(self._internContact(contact, update=True))
+            except TalkException:
                 pass
-            elif operation.type == OT.SEND_MESSAGE:
+
+    def _syncGroup(self, id, removed=False):
+        """Re-fetch one group into the indexes, or drop it"""
+        self._unindexGroup(id)
+
+        if not removed:
+            try:
+                for group in self._client.getGroups([id]):
+                    self._indexGroup(LineGroup(self, group))
+            except TalkException:
                 pass
-            elif operation.type == OT.RECEIVE_MESSAGE:
-                message = LineMessage(self, operation.message)
-                group_or_contact = self.getContactOrGroupFromId(message.to)
 
-                yield (group_or_contact, message)
-            else:
-                print "[*] %s" % OT._VALUES_TO_NAMES[operation.type]
-                print operation
+    def _getImageFromURL(self, url):
+        """Download an image, streaming at most `image_max_size` bytes"""
+        data = self.previewCache.get(('url', url))
+        if data is not None:
+            return data
+
+        response = self._session.get(url, stream=True)
+
+        try:
+            response.raise_for_status()
+
+            length = int(response.headers.get('content-length') or 0)
+            if length > self.image_max_size:
+                self.raise_error("image is larger than %d bytes" % self.image_max_size)
+
+            chunks = []
+            size   = 0
+
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.image_max_size:
+                    self.raise_error("image is larger than %d bytes" % self.image_max_size)
+
+                chunks.append(chunk)
+        finally:
+            response.close()
+
+        data = b"".join(chunks)
+        self.previewCache.put(('url', url), data)
+
+        return data
+
+    def _getImageFromFile(self, path):
+        """Read a local image through mmap, cached by its sha1"""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+
+            if size > self.image_max_size:
+                self.raise_error("image is larger than %d bytes" % self.image_max_size)
+            if not size:
+                self.raise_error("image is empty")
 
-            self.revision = max(operation.revision, self.revision)
+            image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                key  = ('sha1', hashlib.sha1(image).hexdigest())
+                data = self.previewCache.get(key)
+
+                if data is None:
+                    data = image[:]
+                    self.previewCache.put(key, data)
+            finally:
+                image.close()
+
+        return data
 
     def raise_error(self, msg):
         """Fix a error format"""
@@ -507,7 +1393,20 @@ class LineClient(object):
 
     def get_json(self, url):
         """Get josn from given url with saved session and headers"""
-        return json.loads(self._session.get(url, headers=self._headers).text)
+        if self.metrics is None:
+            return json.loads(self._session.get(url, headers=self._headers).text)
+
+        start = time.time()
+        try:
+            response = self._session.get(url, headers=self._headers)
+        except Exception:
+            self.metrics.record("GET " + url, time.time() - start, error=True)
+            raise
+
+        self.metrics.record("GET " + url, time.time() - start, 0,
+                            len(response.content), response.status_code >= 400)
+
+        return json.loads(response.text)
 
     def check_auth(self):
         """Check if client is logged in or not"""
@@ -595,6 +1494,11 @@ class LineClient(object):
         if self.check_auth():
             return self._client.getRecentMessages(id, count)
 
+    def _getPreviousMessages(self, id, endMessageId, count=100):
+        """Get up to `count` messages of `id` older than `endMessageId`"""
+        if self.check_auth():
+            return self._client.getPreviousMessages(id, endMessageId, count)
+
     def _sendMessage(self, message, seq=0):
         """Send a message to `id`. `id` could be contact id or group id
 
@@ -604,6 +1508,24 @@ class LineClient(object):
         if self.check_auth():
             return self._client.sendMessage(seq, message)
 
+    def broadcast(self, ids, text, workers=8, rate=None):
+        """Send `text` to many contacts or groups at once
+
+        The `sendMessage` call is serialized once and sent with at most
+        `workers` in flight, slowing down whenever the server throttles.
+
+        :param ids: list of `contact` id or `group` id
+        :param text: text to send
+        :param workers: (optional) sends in flight at once
+        :param rate: (optional) sends per second to start with
+        :returns: dict of id to the sent Message, or the exception that
+                  stopped it
+        """
+        if self.check_auth():
+            message = CurveThrift.Message(text=text)
+
+            return broadcast(self, ids, message, workers, rate)
+
     def _getLastOpRevision(self):
         if self.check_auth():
             return self._client.getLastOpRevision()
@@ -618,5 +1540,4 @@ class LineClient(object):
                 return self._client.getMessageBoxCompactWrapUp(id)
             except Exception as e:
                 msg = e
-                raise_error(msg)
-
+                self.raise_error(msg)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+    line.health
+    ~~~~~~~~~~~
+
+    Bulk validation of stored authTokens.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import Queue
+import requests
+import threading
+
+from curve.ttypes import TalkException, ErrorCode
+
+from .client import LineClient
+from .transport import ConnectionPool
+
+EXPIRED_CODES = frozenset(getattr(ErrorCode, name)
+                          for name in ('AUTHENTICATION_FAILED', 'NOT_AUTHORIZED_DEVICE')
+                          if hasattr(ErrorCode, name))
+
+def checkToken(authToken, pool=None, session=None):
+    """Check one authToken with a single `getLastOpRevision` call
+
+    :returns: dict of `authToken`, `status` ('valid', 'expired' or
+              'error'), TalkException `code`, `revision`, `error` and
+              `latency` in seconds
+    """
+    result = {'authToken': authToken, 'status': 'valid', 'code': None,
+              'revision': None, 'error': None}
+
+    client = LineClient(authToken=authToken, lazy=True, pool=pool, session=session)
+
+    start = time.time()
+    try:
+        result['revision'] = client._newClient(client.LINE_HTTP_URL).getLastOpRevision()
+    except TalkException as e:
+        result['status'] = 'expired' if e.code in EXPIRED_CODES else 'error'
+        result['code']   = e.code
+        result['error']  = e.reason
+    except Exception as e:
+        result['status'] = 'error'
+        result['error']  = str(e)
+
+    result['latency'] = time.time() - start
+
+    return result
+
+def checkTokens(authTokens, workers=32, pool=None):
+    """Check many authTokens concurrently over shared keep-alive
+    connections, yielding `checkToken` results as they complete
+
+    :param authTokens: iterable of authToken
+    :param workers: (optional) checks in flight at once
+    :param pool: (optional) ConnectionPool to use
+    """
+    tasks   = Queue.Queue()
+    results = Queue.Queue()
+
+    for authToken in authTokens:
+        tasks.put(authToken)
+
+    total = tasks.qsize()
+    if not total:
+        return
+
+    pool    = pool or ConnectionPool(size=workers)
+    session = requests.session()
+
+    def worker():
+        while True:
+            try:
+                authToken = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            results.put(checkToken(authToken, pool, session))
+
+    for i in xrange(min(workers, total)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    for i in xrange(total):
+        yield results.get()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    line.history
+    ~~~~~~~~~~~~
+
+    Paging through message history and exporting it with a resumable
+    cursor.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import base64
+import struct
+
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+
+from curve.ttypes import Message
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+def iterHistoryPages(client, messageBoxId, cursor=None, pageSize=100):
+    """Yield the Messages of a message box from newest to oldest as one
+    list per request
+
+    :param client: LineClient instance
+    :param messageBoxId: id of the message box
+    :param cursor: (optional) id of the oldest message already seen;
+                   only older messages are yielded
+    :param pageSize: (optional) messages per request
+    """
+    while True:
+        if cursor is None:
+            page = client._getRecentMessages(messageBoxId, pageSize)
+        else:
+            page = client._getPreviousMessages(messageBoxId, cursor, pageSize)
+
+        page = sorted(page or [], key=lambda message: int(message.id), reverse=True)
+
+        messages = []
+        for message in page:
+            if cursor is not None and int(message.id) >= cursor:
+                continue
+
+            cursor = int(message.id)
+            messages.append(message)
+
+        if not messages:
+            return
+
+        yield messages
+
+def iterHistory(client, messageBoxId, cursor=None, pageSize=100):
+    """Yield Messages of a message box from newest to oldest, one page
+    of `pageSize` at a time
+
+    Takes the same arguments as `iterHistoryPages`.
+    """
+    for page in iterHistoryPages(client, messageBoxId, cursor, pageSize):
+        for message in page:
+            yield message
+
+class JsonLinesWriter(object):
+    """Write Messages as JSON lines"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, message):
+        preview = message.contentPreview
+        if preview:
+            preview = base64.b64encode(preview)
+
+        self.f.write(json.dumps({
+            'id': message.id,
+            'from': message._from,
+            'to': message.to,
+            'toType': message.toType,
+            'createdTime': message.createdTime,
+            'text': message.text,
+            'contentType': message.contentType,
+            'contentMetadata': message.contentMetadata,
+            'contentPreview': preview,
+        }) + "\n")
+
+    def flush(self):
+        self.f.flush()
+
+class CompactWriter(object):
+    """Write Messages as length-prefixed `TCompactProtocol` structs"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, message):
+        transport = TTransport.TMemoryBuffer()
+        message.write(TCompactProtocol.TCompactProtocol(transport))
+
+        data = transport.getvalue()
+
+        self.f.write(struct.pack(">I", len(data)))
+        self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+def readCompact(f):
+    """Yield Messages written by `CompactWriter`"""
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+
+        size, = struct.unpack(">I", header)
+
+        message = Message()
+        message.read(TCompactProtocol.TCompactProtocol(
+                TTransport.TMemoryBuffer(f.read(size))))
+
+        yield message
+
+WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'compact': CompactWriter,
+}
+
+def exportHistory(client, messageBoxId, path, format='jsonl', cursorPath=None, pageSize=100):
+    """Append the history of a message box to `path`
+
+    After every page the file is flushed, and the id of the oldest
+    message written is saved to `cursorPath` with the file's length. An
+    interrupted export started again with the same `cursorPath` cuts off
+    anything written after the last saved page and picks up from there.
+
+    :param format: (optional) 'jsonl' or 'compact'
+    :param cursorPath: (optional) file keeping the resume cursor
+    :returns: number of messages written
+    """
+    cursor, offset = _loadCursor(cursorPath)
+    count = 0
+
+    if offset is not None:
+        _truncate(path, offset)
+
+    with open(path, 'ab') as f:
+        f.seek(0, os.SEEK_END)
+
+        if cursorPath and offset is None:
+            _saveCursor(cursorPath, cursor, f.tell())
+
+        writer = WRITERS[format](f)
+
+        for page in iterHistoryPages(client, messageBoxId, cursor, pageSize):
+            for message in page:
+                writer.write(message)
+                count += 1
+
+            writer.flush()
+
+            if cursorPath:
+                _saveCursor(cursorPath, int(message.id), f.tell())
+
+    return count
+
+def _loadCursor(path):
+    """`(cursor, offset)` saved at `path`"""
+    try:
+        with open(path) as f:
+            state = json.loads(f.read())
+    except (TypeError, IOError, ValueError):
+        return None, None
+
+    return state.get('cursor'), state.get('offset')
+
+def _saveCursor(path, cursor, offset):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write(json.dumps({'cursor': cursor, 'offset': offset}))
+
+    os.rename(tmp, path)
+
+def _truncate(path, offset):
+    """Cut off what an interrupted export wrote after its last page"""
+    try:
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+    except IOError:
+        pass
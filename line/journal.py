@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+    line.journal
+    ~~~~~~~~~~~~
+
+    Append-only journal of processed operations with a durable revision
+    checkpoint.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import struct
+
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+
+from curve.ttypes import Operation
+
+class OperationJournal(object):
+    """Journal of operations a LineClient has handed to its handlers.
+
+    Records are buffered and made durable together by `commit`, which
+    fsyncs the journal and then rewrites the checkpoint (revision and
+    journal offset). A commit happens every `commit_count` records or
+    `commit_interval` seconds, so there is no fsync per event.
+
+    On open the journal is scanned from the checkpoint offset, so
+    records that reached the disk after the last checkpoint still count.
+    A torn record at the end is cut off.
+
+    Attributes:
+        revision    highest revision recorded, None for a new journal
+
+    :param path: journal file, the checkpoint is kept at `path.checkpoint`
+    :param commit_count: (optional) records per group commit
+    :param commit_interval: (optional) seconds between group commits
+    """
+    def __init__(self, path, commit_count=100, commit_interval=1.0):
+        self.path            = path
+        self.checkpoint_path = path + ".checkpoint"
+
+        self.commit_count    = commit_count
+        self.commit_interval = commit_interval
+
+        self.revision = None
+
+        self._pending     = 0
+        self._last_commit = time.time()
+
+        self._recover()
+
+        self._f = open(self.path, 'ab')
+
+    def isProcessed(self, revision):
+        return self.revision is not None and revision <= self.revision
+
+    def record(self, operation):
+        """Append a processed operation, committing if a group is full"""
+        transport = TTransport.TMemoryBuffer()
+        operation.write(TCompactProtocol.TCompactProtocol(transport))
+
+        data = transport.getvalue()
+
+        self._f.write(struct.pack(">I", len(data)))
+        self._f.write(data)
+
+        self.revision = max(operation.revision, self.revision)
+        self._pending += 1
+
+        if self._pending >= self.commit_count or \
+           time.time() - self._last_commit >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Make all recorded operations and the checkpoint durable"""
+        self._last_commit = time.time()
+
+        if not self._pending:
+            return
+
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("%d %d" % (self.revision, self._f.tell()))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, self.checkpoint_path)
+
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._f.close()
+
+    def __iter__(self):
+        """Yield the recorded Operations"""
+        self._f.flush()
+
+        with open(self.path, 'rb') as f:
+            for offset, operation in self._scan(f):
+                yield operation
+
+    def _recover(self):
+        offset = 0
+
+        try:
+            with open(self.checkpoint_path) as f:
+                revision, offset = [int(field) for field in f.read().split()]
+                self.revision = revision
+        except (IOError, ValueError):
+            offset = 0
+
+        try:
+            f = open(self.path, 'r+b')
+        except IOError:
+            return
+
+        with f:
+            f.seek(offset)
+
+            end = offset
+            for end, operation in self._scan(f):
+                self.revision = max(operation.revision, self.revision)
+
+            f.truncate(end)
+
+    def _scan(self, f):
+        """Yield `(end offset, Operation)` of complete records in `f`"""
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+
+            size, = struct.unpack(">I", header)
+
+            data = f.read(size)
+            if len(data) < size:
+                return
+
+            operation = Operation()
+            try:
+                operation.read(TCompactProtocol.TCompactProtocol(
+                        TTransport.TMemoryBuffer(data)))
+            except Exception:
+                return
+
+            yield f.tell(), operation
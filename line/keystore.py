@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    line.keystore
+    ~~~~~~~~~~~~~
+
+    Local store of authTokens and login certificates per account.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+class Keystore(object):
+    """authToken and certificate of each account in a JSON file that only
+    the owner can read.
+
+    A stored certificate lets the next login skip the PinCode step, and a
+    stored authToken that still works skips the login altogether.
+
+    :param path: keystore file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def get(self, id):
+        """Get `{'authToken': ..., 'certificate': ...}` stored for `id`"""
+        with self._lock:
+            return self._load().get(id, {})
+
+    def put(self, id, authToken=None, certificate=None):
+        """Store the authToken and certificate of `id`"""
+        with self._lock:
+            entries = self._load()
+            entry   = entries.setdefault(id, {})
+
+            entry['authToken'] = authToken
+            if certificate:
+                entry['certificate'] = certificate
+
+            self._save(entries)
+
+    def remove(self, id):
+        """Forget everything stored for `id`"""
+        with self._lock:
+            entries = self._load()
+
+            if entries.pop(id, None) is not None:
+                self._save(entries)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        tmp = self.path + ".tmp"
+
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+
+        os.rename(tmp, self.path)
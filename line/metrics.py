@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    line.metrics
+    ~~~~~~~~~~~~
+
+    Per-method call counts, latency histograms and payload sizes of
+    LineClient RPCs.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import threading
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metrics(object):
+    """Thread-safe RPC statistics
+
+        >>> client = LineClient(authToken=token, metrics=Metrics())
+        >>> client.metrics.asDict()['getProfile']['count']
+        1
+        >>> print client.metrics.prometheus()
+
+    :param buckets: (optional) upper bounds of the latency histogram
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+
+        self._methods = {}
+        self._lock    = threading.Lock()
+
+    def record(self, method, seconds, sent=0, received=0, error=False):
+        """Record one call of `method`"""
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = {
+                    'count': 0, 'errors': 0, 'seconds': 0.0,
+                    'sent': 0, 'received': 0,
+                    'buckets': [0] * (len(self.buckets) + 1),
+                }
+
+            stats['count']    += 1
+            stats['seconds']  += seconds
+            stats['sent']     += sent
+            stats['received'] += received
+
+            if error:
+                stats['errors'] += 1
+
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+
+            stats['buckets'][i] += 1
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+
+    def asDict(self):
+        """Statistics per method, with cumulative histogram buckets keyed
+        by upper bound"""
+        result = {}
+
+        with self._lock:
+            for method, stats in self._methods.iteritems():
+                buckets = {}
+                total   = 0
+
+                for bound, n in zip(self.buckets + (float('inf'),), stats['buckets']):
+                    total += n
+                    buckets[bound] = total
+
+                result[method] = dict(stats, buckets=buckets)
+
+        return result
+
+    def prometheus(self, prefix='line_client'):
+        """Statistics in the Prometheus text exposition format"""
+        stats = self.asDict()
+        lines = []
+
+        for name, key, kind in (('calls_total', 'count', 'counter'),
+                                ('errors_total', 'errors', 'counter'),
+                                ('sent_bytes_total', 'sent', 'counter'),
+                                ('received_bytes_total', 'received', 'counter')):
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for method in sorted(stats):
+                lines.append('%s_%s{method="%s"} %s' % (prefix, name, method, stats[method][key]))
+
+        lines.append("# TYPE %s_call_seconds histogram" % prefix)
+        for method in sorted(stats):
+            for bound in sorted(stats[method]['buckets']):
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('%s_call_seconds_bucket{method="%s",le="%s"} %d'
+                             % (prefix, method, le, stats[method]['buckets'][bound]))
+
+            lines.append('%s_call_seconds_sum{method="%s"} %r' % (prefix, method, stats[method]['seconds']))
+            lines.append('%s_call_seconds_count{method="%s"} %d' % (prefix, method, stats[method]['count']))
+
+        return "\n".join(lines) + "\n"
+
+class TInstrumentedClient(object):
+    """Wraps a Thrift client and records every RPC in `metrics`. Request
+    and response sizes are read from transports that report `lastSent`
+    and `lastReceived`.
+
+    :param client: Thrift client
+    :param metrics: Metrics instance
+    """
+    def __init__(self, client, metrics):
+        self._client  = client
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+
+        if name.startswith(('_', 'send_', 'recv_')) or not callable(attr):
+            return attr
+
+        client  = self._client
+        metrics = self._metrics
+
+        def call(*args, **kwargs):
+            error = False
+            start = time.time()
+
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                seconds   = time.time() - start
+                transport = client._oprot.trans
+
+                metrics.record(name, seconds,
+                               getattr(transport, 'lastSent', 0),
+                               getattr(transport, 'lastReceived', 0),
+                               error)
+
+        return call
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    line.poller
+    ~~~~~~~~~~~
+
+    Background long polling with a bounded event queue.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import Queue
+import threading
+
+from curve import CurveThrift
+
+class PendingSend(object):
+    """Result of a queued `LinePoller.sendMessage`"""
+
+    def __init__(self, to, text):
+        self.to     = to
+        self.text   = text
+        self.result = None
+        self.error  = None
+
+        self._done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait until the message is sent
+
+        :returns: True if sent, False if still pending after `timeout`
+        """
+        self._done.wait(timeout)
+
+        if self.error is not None:
+            raise self.error
+
+        return self._done.is_set()
+
+class LinePoller(object):
+    """Long-polls `LINE_HTTP_IN_URL` on a background thread and queues
+    `(LineContact|LineGroup, LineMessage)` events.
+
+    The queue is bounded: when handlers fall behind, the poll thread
+    blocks on it and stops fetching until there is room again. Messages
+    are sent by worker threads through the client's multiplexed
+    transports, so polling, sending and the
+    handlers all run at the same time.
+
+    With a journal on the client, an operation is recorded by `get` only
+    once the consumer comes back for the event after it, so events still
+    queued at a crash are delivered again. Operations that yield no event
+    wait in the queue behind the ones before them, keeping the journal
+    in order. Use one consumer thread when the client has a journal.
+
+        >>> poller = LinePoller(client)
+        >>> poller.start()
+        >>> for receiver, message in poller:
+        ...     poller.sendMessage(message.sender.id, "pong")
+
+    :param client: LineClient instance
+    :param maxsize: (optional) size of the event queue
+    :param count: (optional) operations per `fetchOperations`
+    :param send_workers: (optional) number of threads sending messages
+    """
+    def __init__(self, client, maxsize=1000, count=50, send_workers=2):
+        self.client = client
+        self.count  = count
+
+        self.events = Queue.Queue(maxsize)
+        self.sends  = Queue.Queue(maxsize)
+
+        self.send_workers = send_workers
+
+        self._running = threading.Event()
+        self._threads = []
+        self._error   = None
+
+    def start(self):
+        """Start the poll and send threads"""
+        self._running.set()
+
+        self._spawn(self._poll)
+        for i in xrange(self.send_workers):
+            self._spawn(self._send)
+
+        return self
+
+    def stop(self):
+        """Stop after the current `fetchOperations` returns"""
+        self._running.clear()
+
+        for i in xrange(self.send_workers):
+            self.sends.put(None)
+
+    def get(self, timeout=None):
+        """Get the next event, or None after `timeout` seconds
+
+        Asking for an event acknowledges the one returned before it: its
+        operations are recorded to the client's journal now.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            try:
+                item = self.events.get(timeout=None if deadline is None
+                                       else max(0, deadline - time.time()))
+            except Queue.Empty:
+                return None
+
+            if item is None:
+                self.events.put(None)
+                raise self._error or StopIteration()
+
+            kind, value = item
+
+            if kind == 'event':
+                return value
+            elif kind == 'record':
+                self.client._journal.record(value)
+            elif kind == 'commit':
+                self.client._journal.commit()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+    def sendMessage(self, to, text):
+        """Queue a text message to `to`, blocking while the send queue
+        is full
+
+        :param to: `contact` id or `group` id
+        :returns: PendingSend instance
+        """
+        pending = PendingSend(to, text)
+        self.sends.put(pending)
+
+        return pending
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+        self._threads.append(thread)
+
+    def _poll(self):
+        journal = self.client._journal
+
+        # with a journal, records follow their event through the queue and
+        # are made by the consumer, see `get`
+        record = (lambda operation: self.events.put(('record', operation))) \
+                 if journal else None
+
+        try:
+            while self._running.is_set():
+                for event in self.client.longPoll(self.count, record):
+                    self.events.put(('event', event))
+
+                if journal:
+                    self.events.put(('commit', None))
+        except Exception as e:
+            self._error = e
+        finally:
+            self._running.clear()
+            self.events.put(None)
+
+    def _send(self):
+        while True:
+            pending = self.sends.get()
+            if pending is None:
+                return
+
+            try:
+                message = CurveThrift.Message(to=pending.to, text=pending.text)
+                pending.result = self.client._sendMessage(message)
+            except Exception as e:
+                pending.error = e
+            finally:
+                pending._done.set()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+    line.replay
+    ~~~~~~~~~~~
+
+    Recording the Thrift traffic of a LineClient and replaying it
+    offline.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import struct
+import urlparse
+import threading
+from cStringIO import StringIO
+from collections import deque
+
+from thrift.transport import TTransport
+
+HEADER = struct.Struct(">dHII")
+
+class TrafficRecorder(object):
+    """Appends request/response frames to a file.
+
+    Each frame is a `(time, len(path), len(request), len(response))`
+    header followed by the endpoint path and the raw `TCompactProtocol`
+    bytes of both directions.
+
+    :param path: file to append to
+    """
+    def __init__(self, path):
+        self._f    = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, request, response):
+        frame = HEADER.pack(time.time(), len(endpoint), len(request), len(response))
+
+        with self._lock:
+            self._f.write(frame)
+            self._f.write(endpoint)
+            self._f.write(request)
+            self._f.write(response)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+def readTraffic(path):
+    """Yield `(time, endpoint, request, response)` frames of a recording"""
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+
+            timestamp, endpoint, request, response = HEADER.unpack(header)
+
+            yield (timestamp, f.read(endpoint), f.read(request), f.read(response))
+
+def endpointOf(url):
+    return urlparse.urlparse(url).path.encode('utf-8')
+
+class TRecordingTransport(TTransport.TTransportBase, TTransport.CReadableTransport):
+    """Passes everything to a `TPooledHttpClient` and records each
+    request with its response
+
+    :param transport: TPooledHttpClient instance
+    :param recorder: TrafficRecorder instance
+    """
+    def __init__(self, transport, recorder):
+        self._transport = transport
+        self._recorder  = recorder
+        self._endpoint  = endpointOf(transport.path)
+
+        self._wbuf = StringIO()
+
+    def write(self, buf):
+        self._wbuf.write(buf)
+        self._transport.write(buf)
+
+    def flush(self):
+        request = self._wbuf.getvalue()
+        self._wbuf = StringIO()
+
+        self._transport.flush()
+        self._recorder.record(self._endpoint, request, self._transport.lastResponse)
+
+    def read(self, sz):
+        return self._transport.read(sz)
+
+    @property
+    def cstringio_buf(self):
+        return self._transport.cstringio_buf
+
+    def cstringio_refill(self, partialread, reqlen):
+        return self._transport.cstringio_refill(partialread, reqlen)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+class TrafficReplay(object):
+    """Serves recorded responses per endpoint in recorded order.
+
+    :param path: recording made with `TrafficRecorder`
+    :param speed: (optional) 1.0 keeps the recorded pacing, 2.0 replays
+                  twice as fast, None replays as fast as possible
+    """
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+
+        self._frames = {}
+        self._lock   = threading.Lock()
+        self._start  = None
+        self._first  = None
+
+        for timestamp, endpoint, request, response in readTraffic(path):
+            if self._first is None:
+                self._first = timestamp
+
+            self._frames.setdefault(endpoint, deque()).append((timestamp, response))
+
+    def transport(self, url):
+        """Make a transport replaying the traffic recorded for `url`"""
+        return TReplayTransport(self, endpointOf(url))
+
+    def next(self, endpoint):
+        """Wait until the next response of `endpoint` is due and return it"""
+        with self._lock:
+            frames = self._frames.get(endpoint)
+            if not frames:
+                raise TTransport.TTransportException(
+                        TTransport.TTransportException.END_OF_FILE,
+                        "recording of %s is exhausted" % endpoint)
+
+            timestamp, response = frames.popleft()
+
+            if self._start is None:
+                self._start = time.time()
+
+        if self.speed:
+            delay = self._start + (timestamp - self._first) / self.speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        return response
+
+class TReplayTransport(TTransport.TTransportBase, TTransport.CReadableTransport):
+    """Transport that discards requests and answers with the next
+    recorded response of its endpoint"""
+
+    def __init__(self, replay, endpoint):
+        self._replay   = replay
+        self._endpoint = endpoint
+
+        self._rbuf = StringIO()
+        self._sent = 0
+
+        self.lastSent     = 0
+        self.lastReceived = 0
+        self.lastResponse = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def isOpen(self):
+        return True
+
+    def setCustomHeaders(self, headers):
+        pass
+
+    def write(self, buf):
+        self._sent += len(buf)
+
+    def flush(self):
+        response = self._replay.next(self._endpoint)
+
+        self.lastSent     = self._sent
+        self.lastReceived = len(response)
+        self.lastResponse = response
+        self._sent = 0
+        self._rbuf = StringIO(response)
+
+    def read(self, sz):
+        return self._rbuf.read(sz)
+
+    @property
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        raise EOFError()
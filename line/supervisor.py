@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+    line.supervisor
+    ~~~~~~~~~~~~~~~
+
+    Long polling many accounts from a pool of worker processes.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import time
+import Queue
+import threading
+import multiprocessing
+
+from thrift.transport import TTransport
+
+from curve import CurveThrift
+from curve.ttypes import TalkException
+
+from .client import LineClient
+from .transport import compactProtocol
+
+def _loads(frame):
+    """Operations of a raw `fetchOperations` reply"""
+    client = CurveThrift.Client(compactProtocol(TTransport.TMemoryBuffer(frame), True))
+
+    return client.recv_fetchOperations()
+
+class Supervisor(object):
+    """Shards `LineClient(authToken=...)` long-poll loops over worker
+    processes, one per core by default, so dispatch is not bound by one
+    interpreter's GIL.
+
+    Operations are dispatched in the workers: `setup` is called with
+    each account's client there to register handlers and filters, and
+    `dispatchOperations` runs them, keeps the client's indexes in sync
+    and records its journal. With `forward`, each fetch that was
+    dispatched is also sent to the parent in batches over a pipe-backed
+    queue, as the raw `fetchOperations` reply, and decoded only there.
+
+    The parent keeps the last revision handled per account, starting
+    from the revision each worker reports when it picks an account up.
+    A crashed worker is started again with its accounts resuming from
+    those revisions, and when a worker is saturated its busiest account
+    moves to the least loaded worker. Operations a moved or restarted
+    account sends twice are dropped by revision.
+
+        >>> supervisor = Supervisor(tokens).start()
+        >>> for authToken, operation in supervisor:
+        ...     handle(authToken, operation)
+
+    Attributes:
+        revisions   last revision delivered per authToken
+        errors      TalkException `(code, reason)` of accounts that stopped
+
+    :param authTokens: authTokens to poll
+    :param processes: (optional) number of workers, default cpu count
+    :param count: (optional) operations per `fetchOperations`
+    :param batch_size: (optional) fetches per batch sent to the parent
+    :param batch_interval: (optional) longest wait before a batch is sent
+    :param saturation: (optional) worker CPU use, from 0 to 1, above
+                       which accounts are moved away
+    :param client_kwargs: (optional) extra LineClient arguments
+    :param setup: (optional) picklable callable taking each LineClient in
+                  its worker, e.g. a module-level function that calls
+                  `addHandler`
+    :param forward: (optional) deliver operations to the parent; without
+                    it only revisions are reported and `get` returns no
+                    events
+    """
+    stats_interval     = 1.0
+    rebalance_cooldown = 10.0
+
+    def __init__(self, authTokens, processes=None, count=50, batch_size=100,
+                 batch_interval=0.1, saturation=0.9, client_kwargs=None,
+                 setup=None, forward=True):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.options   = {
+            'count': count,
+            'batch_size': batch_size,
+            'batch_interval': batch_interval,
+            'stats_interval': self.stats_interval,
+            'client_kwargs': client_kwargs or {},
+            'setup': setup,
+            'forward': forward,
+        }
+        self.saturation = saturation
+
+        self.revisions = dict((authToken, None) for authToken in authTokens)
+        self.errors    = {}
+
+        self._output   = multiprocessing.Queue()
+        self._workers  = [None] * self.processes
+        self._shards   = [set() for i in xrange(self.processes)]
+        self._load     = [0.0] * self.processes
+        self._counts   = [{} for i in xrange(self.processes)]
+        self._moved    = 0
+        self._running  = False
+
+        for i, authToken in enumerate(self.revisions):
+            self._shards[i % self.processes].add(authToken)
+
+    def start(self):
+        self._running = True
+
+        for index in xrange(self.processes):
+            self._spawn(index)
+
+        return self
+
+    def stop(self):
+        self._running = False
+
+        for worker in self._workers:
+            if worker is not None:
+                process, commands = worker
+                try:
+                    commands.send(('stop',))
+                except (IOError, EOFError):
+                    pass
+
+        for worker in self._workers:
+            if worker is not None:
+                process, commands = worker
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+
+    def __iter__(self):
+        while self._running:
+            for event in self.get(self.stats_interval):
+                yield event
+
+    def get(self, timeout=None):
+        """Wait for the next batch and return its new
+        `(authToken, Operation)` events"""
+        self._supervise()
+
+        try:
+            message = self._output.get(timeout=timeout)
+        except Queue.Empty:
+            return []
+
+        kind, index = message[0], message[1]
+
+        if kind == 'events':
+            return self._deliver(message[2])
+        elif kind == 'revision':
+            authToken, revision = message[2:]
+            if self.revisions.get(authToken) is None:
+                self.revisions[authToken] = revision
+        elif kind == 'stats':
+            self._load[index], self._counts[index] = message[2], message[3]
+            self._rebalance()
+        elif kind == 'error':
+            authToken, code, reason = message[2:]
+            self.errors[authToken] = (code, reason)
+            self._shards[index].discard(authToken)
+
+        return []
+
+    def _deliver(self, records):
+        events = []
+
+        for authToken, revision, frame in records:
+            last = self.revisions.get(authToken)
+            if last is not None and revision <= last:
+                continue
+
+            self.revisions[authToken] = revision
+
+            if frame is None:
+                continue
+
+            for operation in _loads(frame):
+                if last is None or operation.revision > last:
+                    events.append((authToken, operation))
+
+        return events
+
+    def _spawn(self, index):
+        commands, remote = multiprocessing.Pipe()
+
+        process = multiprocessing.Process(target=_work,
+                                          args=(index, remote, self._output, self.options))
+        process.daemon = True
+        process.start()
+
+        for authToken in self._shards[index]:
+            commands.send(('add', authToken, self.revisions.get(authToken)))
+
+        self._workers[index] = (process, commands)
+
+    def _supervise(self):
+        """Restart workers that died"""
+        if not self._running:
+            return
+
+        for index, (process, commands) in enumerate(self._workers):
+            if not process.is_alive():
+                self._load[index] = 0.0
+                self._spawn(index)
+
+    def _rebalance(self):
+        """Move the busiest account of a saturated worker"""
+        now = time.time()
+        if now - self._moved < self.rebalance_cooldown:
+            return
+
+        source = max(xrange(self.processes), key=lambda i: self._load[i])
+        target = min(xrange(self.processes), key=lambda i: self._load[i])
+
+        if source == target or len(self._shards[source]) < 2 or \
+           self._load[source] < self.saturation or \
+           self._load[target] > self.saturation / 2:
+            return
+
+        counts = self._counts[source]
+        authToken = max(self._shards[source], key=lambda token: counts.get(token, 0))
+
+        self._shards[source].discard(authToken)
+        self._shards[target].add(authToken)
+
+        self._workers[source][1].send(('remove', authToken))
+        self._workers[target][1].send(('add', authToken, self.revisions.get(authToken)))
+
+        self._moved = now
+
+def _work(index, commands, output, options):
+    """Worker process: one long-poll thread per account, dispatching
+    operations there and batching records to `output`"""
+    count   = options['count']
+    setup   = options['setup']
+    forward = options['forward']
+
+    polls   = {}
+    buffer  = []
+    counts  = {}
+    lock    = threading.Lock()
+
+    # accounts whose client could not be built, retried by the main loop
+    retries = Queue.Queue()
+
+    def poll(authToken, revision, stopped):
+        try:
+            client = LineClient(authToken=authToken, lazy=True, **options['client_kwargs'])
+            if setup is not None:
+                setup(client)
+
+            if revision is not None:
+                client.revision = revision
+            else:
+                revision = client.revision
+        except Exception:
+            time.sleep(1)
+            retries.put((authToken, revision, stopped))
+            return
+
+        # the parent resumes a restarted account from here until it
+        # delivers something newer
+        output.put(('revision', index, authToken, revision))
+
+        while not stopped.is_set():
+            try:
+                operations = client._client_in.fetchOperations(client.revision, count)
+                if not operations:
+                    continue
+
+                frame = client.transport_in.lastResponse if forward else None
+
+                for event in client.dispatchOperations(operations):
+                    pass
+            except TalkException as e:
+                if e.code == 9:
+                    output.put(('error', index, authToken, e.code, e.reason))
+                    return
+                time.sleep(1)
+                continue
+            except Exception:
+                time.sleep(1)
+                continue
+
+            with lock:
+                buffer.append((authToken, client.revision, frame))
+                counts[authToken] = counts.get(authToken, 0) + len(operations)
+
+    def handle(command):
+        if command[0] == 'add':
+            authToken, revision = command[1:]
+            if authToken in polls:
+                return
+
+            stopped = threading.Event()
+            thread  = threading.Thread(target=poll, args=(authToken, revision, stopped))
+            thread.daemon = True
+            thread.start()
+
+            polls[authToken] = stopped
+        elif command[0] == 'remove':
+            stopped = polls.pop(command[1], None)
+            if stopped is not None:
+                stopped.set()
+
+    last_stats = time.time()
+    last_cpu   = sum(os.times()[:2])
+
+    while True:
+        if commands.poll(options['batch_interval']):
+            command = commands.recv()
+            if command[0] == 'stop':
+                break
+            handle(command)
+
+        while True:
+            try:
+                authToken, revision, stopped = retries.get_nowait()
+            except Queue.Empty:
+                break
+
+            if polls.get(authToken) is stopped and not stopped.is_set():
+                del polls[authToken]
+                handle(('add', authToken, revision))
+
+        with lock:
+            records, buffer[:] = buffer[:], []
+
+        for i in xrange(0, len(records), options['batch_size']):
+            output.put(('events', index, records[i:i + options['batch_size']]))
+
+        now = time.time()
+        if now - last_stats >= options['stats_interval']:
+            cpu = sum(os.times()[:2])
+
+            with lock:
+                snapshot = dict(counts)
+                counts.clear()
+
+            output.put(('stats', index, (cpu - last_cpu) / (now - last_stats), snapshot))
+
+            last_stats, last_cpu = now, cpu
+
+    for stopped in polls.itervalues():
+        stopped.set()
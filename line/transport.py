@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+    line.transport
+    ~~~~~~~~~~~~~~
+
+    Thrift HTTP transport over pooled keep-alive connections, a
+    thread-safe Thrift client on top of it, and the compact protocol
+    those clients speak.
+
+    :copyright: (c) 2014 by Taehoon Kim.
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import socket
+import httplib
+import urlparse
+import threading
+from cStringIO import StringIO
+from contextlib import contextmanager
+
+from thrift.Thrift import TException
+from thrift.transport import TTransport
+from thrift.protocol import TCompactProtocol
+from thrift.protocol.TProtocol import TProtocolException
+
+try:
+    from thrift.protocol import fastbinary
+except ImportError:
+    fastbinary = None
+
+#: whether the C compact protocol can be used
+ACCELERATED = fastbinary is not None and \
+    hasattr(fastbinary, 'decode_compact') and \
+    hasattr(TCompactProtocol, 'TCompactProtocolAccelerated')
+
+def compactProtocol(transport, accelerated=False):
+    """Make a compact protocol on `transport`
+
+    With `accelerated`, structs are encoded and decoded by thrift's C
+    extension when it is installed, falling back to the pure-Python
+    protocol when it is not. Decoding is only accelerated on transports
+    that are `TTransport.CReadableTransport`.
+
+    :param transport: Thrift transport
+    :param accelerated: (optional) use the C protocol when available
+    """
+    if accelerated and ACCELERATED:
+        return TCompactProtocol.TCompactProtocolAccelerated(transport, fallback=True)
+
+    return TCompactProtocol.TCompactProtocol(transport)
+
+class ConnectionPool(object):
+    """Idle HTTP/1.1 connections kept per `(scheme, host, port)`.
+
+    A connection is reused until the server closes it or it has been
+    idle for `idle_timeout` seconds. There is no limit on connections
+    in use; `size` only bounds how many idle ones are kept per host.
+
+    Attributes:
+        stats   dict of `created`, `reused`, `discarded` and `requests`
+                counters
+
+    :param size: (optional) idle connections kept per host
+    :param idle_timeout: (optional) seconds before an idle connection
+                         is closed instead of reused
+    :param timeout: (optional) socket timeout in seconds
+    """
+    def __init__(self, size=4, idle_timeout=60, timeout=None):
+        self.size         = size
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+
+        self.stats = {'created': 0, 'reused': 0, 'discarded': 0, 'requests': 0}
+
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Get an idle connection to `key`, or a new one
+
+        :returns: `(connection, reused)`
+        """
+        now = time.time()
+
+        with self._lock:
+            self.stats['requests'] += 1
+
+            idle = self._idle.get(key)
+            while idle:
+                connection, last_used = idle.pop()
+
+                if now - last_used <= self.idle_timeout:
+                    self.stats['reused'] += 1
+                    return connection, True
+
+                self.stats['discarded'] += 1
+                connection.close()
+
+            self.stats['created'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+        connection.response_class = _PooledResponse
+
+        return connection, False
+
+    def release(self, key, connection):
+        """Return a connection whose response was fully read"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+
+            if len(idle) < self.size:
+                idle.append((connection, time.time()))
+                return
+
+            self.stats['discarded'] += 1
+
+        connection.close()
+
+    def discard(self, connection):
+        """Close a connection that can not be reused"""
+        with self._lock:
+            self.stats['discarded'] += 1
+
+        connection.close()
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.itervalues():
+            for connection, last_used in connections:
+                connection.close()
+
+class TPooledHttpClient(TTransport.TTransportBase, TTransport.CReadableTransport):
+    """Drop-in replacement for `THttpClient.THttpClient` that sends each
+    flush over a keep-alive connection from a `ConnectionPool` instead of
+    opening a new one.
+
+    The whole response body is buffered, so an accelerated protocol can
+    decode it straight from `cstringio_buf`.
+
+    :param uri: url of the Thrift endpoint
+    :param pool: (optional) ConnectionPool to share with other transports
+    """
+    def __init__(self, uri, pool=None):
+        parsed = urlparse.urlparse(uri)
+
+        self.scheme = parsed.scheme
+        self.host   = parsed.hostname
+        self.port   = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        self.path   = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+
+        self.pool = pool or ConnectionPool()
+
+        self.code    = None
+        self.message = None
+        self.headers = None
+
+        self.lastSent     = 0
+        self.lastReceived = 0
+        self.lastResponse = None
+
+        self._key     = (self.scheme, self.host, self.port)
+        self._open    = False
+        self._timeout = None
+        self._custom_headers = None
+
+        self._wbuf = StringIO()
+        self._rbuf = StringIO()
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def isOpen(self):
+        return self._open
+
+    def setTimeout(self, ms):
+        self._timeout = None if ms is None else ms / 1000.0
+
+    def setCustomHeaders(self, headers):
+        self._custom_headers = headers
+
+    def read(self, sz):
+        return self._rbuf.read(sz)
+
+    def write(self, buf):
+        self._wbuf.write(buf)
+
+    @property
+    def cstringio_buf(self):
+        return self._rbuf
+
+    def cstringio_refill(self, partialread, reqlen):
+        # the response is read whole in `flush`, there is nothing to refill
+        raise EOFError()
+
+    def flush(self):
+        data = self._wbuf.getvalue()
+        self._wbuf = StringIO()
+
+        headers = {
+            'Host': self.host,
+            'Content-Type': 'application/x-thrift',
+            'Content-Length': str(len(data)),
+            'User-Agent': 'Python/THttpClient',
+        }
+        if self._custom_headers:
+            headers.update(self._custom_headers)
+
+        while True:
+            connection, reused = self.pool.acquire(self._key)
+            sent = False
+
+            try:
+                self._send(connection, data, headers)
+                sent = True
+
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                self.pool.discard(connection)
+
+                # only an idle connection the server had closed is retried:
+                # either the request was never written or nothing answered
+                # it. Anything else may have reached the server, and calls
+                # like sendMessage must not be made twice.
+                if not reused or sent and not _isUnanswered(e):
+                    raise TTransport.TTransportException(
+                            TTransport.TTransportException.NOT_OPEN, str(e))
+
+        self.code    = response.status
+        self.message = response.reason
+        self.headers = response.msg
+
+        try:
+            body = response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            self.pool.discard(connection)
+            raise TTransport.TTransportException(
+                    TTransport.TTransportException.END_OF_FILE, str(e))
+
+        if response.will_close:
+            self.pool.discard(connection)
+        else:
+            self.pool.release(self._key, connection)
+
+        self.lastSent     = len(data)
+        self.lastReceived = len(body)
+        self.lastResponse = body
+
+        self._rbuf = StringIO(body)
+
+    def _send(self, connection, data, headers):
+        timeout = self._timeout if self._timeout is not None else self.pool.timeout
+
+        connection.timeout = timeout
+        if connection.sock:
+            connection.sock.settimeout(timeout)
+        else:
+            connection.connect()
+            connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # as THttpClient does: the header block must be a byte string, or
+        # httplib joins it with the binary body as unicode and fails.
+        # Headers and body go out in one write, so a kept-alive socket
+        # does not wait on a delayed ACK between them.
+        connection.putrequest('POST', str(self.path),
+                              skip_host=True, skip_accept_encoding=True)
+        for key, value in headers.iteritems():
+            connection.putheader(str(key), str(value))
+        connection.endheaders(data)
+
+class TClientMultiplexer(object):
+    """Thread-safe stand-in for a Thrift client.
+
+    Each call borrows a client made by `factory`, so concurrent calls
+    run on separate transports and protocols. Clients are returned to
+    the pool after the call unless their stream may be broken.
+
+        >>> client = TClientMultiplexer(lambda: make_client())
+        >>> client.getProfile()
+
+    :param factory: callable returning a new Thrift client
+    """
+    def __init__(self, factory):
+        self._factory = factory
+
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        """Borrow an idle client, or make a new one"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        return self._factory()
+
+    def checkin(self, client):
+        """Return a borrowed client"""
+        with self._lock:
+            self._idle.append(client)
+
+    @contextmanager
+    def borrow(self):
+        """Borrow a client for the duration of a `with` block"""
+        client = self.checkout()
+
+        try:
+            yield client
+        except Exception as e:
+            if _isReusable(e):
+                self.checkin(client)
+            raise
+        else:
+            self.checkin(client)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            with self.borrow() as client:
+                return getattr(client, name)(*args, **kwargs)
+
+        call.__name__ = str(name)
+
+        return call
+
+class UnansweredError(httplib.BadStatusLine):
+    """The server closed the connection before any byte of a response"""
+
+class _StatusLine(object):
+    """Wraps a response file to notice an EOF before the status line"""
+
+    def __init__(self, fp):
+        self.fp  = fp
+        self.eof = None
+
+    def readline(self, *args):
+        line = self.fp.readline(*args)
+        if self.eof is None:
+            self.eof = not line
+
+        return line
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+class _PooledResponse(httplib.HTTPResponse):
+    """HTTPResponse raising `UnansweredError` when nothing was read"""
+
+    def begin(self):
+        fp = self.fp = _StatusLine(self.fp)
+
+        try:
+            httplib.HTTPResponse.begin(self)
+        except httplib.BadStatusLine as e:
+            if fp.eof:
+                raise UnansweredError(e.line)
+            raise
+        finally:
+            if self.fp is fp:
+                self.fp = fp.fp
+
+def _isUnanswered(e):
+    """The server closed the connection without sending a status line"""
+    return isinstance(e, UnansweredError)
+
+def _isReusable(e):
+    """A client survives an exception that was read off the wire whole"""
+    return isinstance(e, TException) and \
+        not isinstance(e, (TTransport.TTransportException, TProtocolException))